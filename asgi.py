@@ -0,0 +1,298 @@
+"""
+An ASGI entry point for the reading routes, so that one process can hold
+thousands of idle or long-lived connections:
+
+    uvicorn asgi:app
+
+It serves `/`, `/list`, `/api/unvisited`, `/visit`, `/like`, `/dismiss` and the
+static files with async handlers on top of an async SQLite driver (aiosqlite),
+and responds exactly like the same routes in server.py, whose Flask app still
+serves everything else (managing feeds, stats, backups and the image proxy).
+
+Requests and responses are werkzeug's, like Flask's, and the functions in
+logic.py run on the async connection through `AsyncSession.run_sync`, so the
+two apps share all of their code apart from the handlers below.
+"""
+
+import asyncio
+import datetime
+import io
+import json
+import os
+import sys
+import traceback
+
+import jinja2
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from werkzeug.exceptions import (
+    BadRequest,
+    HTTPException,
+    InternalServerError,
+    NotFound,
+)
+from werkzeug.routing import Map, Rule
+from werkzeug.utils import redirect
+from werkzeug.wrappers import Request, Response
+
+from assets import compress_response, load_static_assets, static_asset_response
+from logic import (
+    VISIT_FLUSH_INTERVAL,
+    flush_visits,
+    item_list,
+    overview,
+    record_dismiss,
+    record_visit,
+    toggle_like,
+    unvisited_items_after,
+)
+from models import migrate
+from templating import format_date, update_query
+
+ROOT_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+def database_url(uri: str):
+    """
+    The URL of the database server.py uses, resolving relative SQLite paths
+    against the instance folder like Flask-SQLAlchemy does.
+    """
+    url = make_url(uri)
+    if url.database and url.database != ":memory:" and not os.path.isabs(url.database):
+        url = url.set(database=os.path.join(ROOT_PATH, "instance", url.database))
+    return url
+
+
+DATABASE_URL = database_url(
+    os.environ.get("RSRSSR_DATABASE_URI", "sqlite:///rss_feeds.db")
+)
+
+migration_engine = create_engine(DATABASE_URL)
+migrate(migration_engine)
+migration_engine.dispose()
+
+engine = create_async_engine(DATABASE_URL.set(drivername="sqlite+aiosqlite"))
+Session = async_sessionmaker(engine)
+
+static_assets = load_static_assets(os.path.join(ROOT_PATH, "static"))
+
+templates = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(os.path.join(ROOT_PATH, "templates")),
+    autoescape=jinja2.select_autoescape(["html", "htm", "xml", "xhtml", "svg"]),
+)
+templates.filters["format_date"] = format_date
+templates.filters["update_query"] = update_query
+templates.globals["static_url"] = (
+    lambda name: f"/static/{static_assets[name].fingerprinted_name}"
+)
+
+
+def render_template(name: str, **context) -> Response:
+    html = templates.get_template(name).render(**context)
+    return Response(html, mimetype="text/html")
+
+
+def jsonify(data) -> Response:
+    """Serialize like Flask's `jsonify` outside of debug mode."""
+    return Response(
+        json.dumps(data, sort_keys=True, separators=(",", ":")) + "\n",
+        mimetype="application/json",
+    )
+
+
+async def page_overview(request: Request) -> Response:
+    async with Session() as session:
+        return await session.run_sync(
+            lambda s: render_template("overview.html", **overview(s))
+        )
+
+
+async def page_item_list(request: Request) -> Response:
+    offset = request.args.get("offset", default=0, type=int)
+    specific_feed_id = request.args.get("feed", default=None, type=int)
+    item_state = request.args.get("k", default="all", type=str)
+    if item_state not in ("all", "visited", "liked"):
+        raise BadRequest()
+
+    async with Session() as session:
+        return await session.run_sync(
+            lambda s: render_template(
+                "index.html",
+                **item_list(s, item_state, offset, specific_feed_id),
+                request=request,
+            )
+        )
+
+
+async def visit_item(request: Request) -> Response:
+    item_id = request.args.get("id", type=int)
+    if not item_id:
+        raise BadRequest()
+    # only appends to the visit log, but that waits while a flush cuts the log
+    await asyncio.to_thread(record_visit, engine, item_id)
+    return Response("", mimetype="text/html")
+
+
+async def like_item(request: Request) -> Response:
+    item_id = request.args.get("id", type=int)
+    if not item_id:
+        raise BadRequest()
+    async with Session() as session:
+        await session.run_sync(toggle_like, item_id)
+    return redirect(request.referrer or "/")
+
+
+async def dismiss_item(request: Request) -> Response:
+    item_id = request.args.get("id", type=int)
+    if not item_id:
+        raise BadRequest()
+    async with Session() as session:
+        await session.run_sync(record_dismiss, item_id)
+    return redirect(request.referrer or "/")
+
+
+async def api_unvisited_items(request: Request) -> Response:
+    date_str = request.args.get("after")
+    if not date_str:
+        raise BadRequest()
+    try:
+        since_date = datetime.datetime.fromisoformat(date_str)
+    except ValueError:
+        raise BadRequest()
+
+    def unvisited(session):
+        return [
+            {
+                "id": item.id,
+                "url": item.link,
+                "feedName": item.feed.title,
+                "published": item.published.isoformat(),
+            }
+            for item in unvisited_items_after(session, since_date)
+        ]
+
+    async with Session() as session:
+        return jsonify(await session.run_sync(unvisited))
+
+
+async def send_static(request: Request, path: str) -> Response:
+    asset = static_assets.get(path)
+    if asset is None:
+        raise NotFound()
+    return static_asset_response(asset, path, request)
+
+
+url_map = Map(
+    [
+        Rule("/", endpoint=page_overview),
+        Rule("/list", endpoint=page_item_list),
+        Rule("/visit", endpoint=visit_item, methods=["POST"]),
+        Rule("/like", endpoint=like_item, methods=["POST"]),
+        Rule("/dismiss", endpoint=dismiss_item, methods=["POST"]),
+        Rule("/api/unvisited", endpoint=api_unvisited_items),
+        Rule("/static/<path:path>", endpoint=send_static),
+    ]
+)
+
+
+async def flush_pending_visits():
+    async with Session() as session:
+        await session.run_sync(flush_visits)
+
+
+async def flush_visits_periodically():
+    while True:
+        await asyncio.sleep(VISIT_FLUSH_INTERVAL)
+        try:
+            await flush_pending_visits()
+        except Exception as e:
+            print(f"failed to write visits: {e}")
+
+
+async def lifespan(receive, send):
+    flusher = None
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            flusher = asyncio.create_task(flush_visits_periodically())
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if flusher is not None:
+                flusher.cancel()
+            await flush_pending_visits()
+            await engine.dispose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+def wsgi_environ(scope, body: bytes) -> dict:
+    """The WSGI environ equivalent to an ASGI HTTP request."""
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": "",
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": False,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        key = name.decode("latin-1").upper().replace("-", "_")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = "HTTP_" + key
+        value = value.decode("latin-1")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        raise NotImplementedError(f"unsupported ASGI scope type {scope['type']}")
+
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    request = Request(wsgi_environ(scope, body))
+
+    try:
+        endpoint, values = url_map.bind_to_environ(request.environ).match()
+        response = await endpoint(request, **values)
+    except HTTPException as e:
+        response = e.get_response(request.environ)
+    except Exception:
+        traceback.print_exc()
+        response = InternalServerError().get_response(request.environ)
+    response = compress_response(response, request)
+
+    await send(
+        {
+            "type": "http.response.start",
+            "status": response.status_code,
+            "headers": [
+                (key.lower().encode("latin-1"), value.encode("latin-1"))
+                for key, value in response.headers.items()
+            ],
+        }
+    )
+    await send(
+        {
+            "type": "http.response.body",
+            "body": b"" if request.method == "HEAD" else response.get_data(),
+        }
+    )
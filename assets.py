@@ -0,0 +1,125 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from flask import Request, Response, request as current_request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# responses smaller than this are sent uncompressed, since compression wouldn't save much
+COMPRESS_MIN_SIZE = 1024
+
+# response types that are compressed on the fly
+COMPRESSIBLE_MIMETYPES = ("text/html", "application/json")
+
+# how long browsers may cache fingerprinted assets for
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# number of hex digits of the content hash included in fingerprinted file names
+FINGERPRINT_LENGTH = 12
+
+
+def available_encodings() -> list[str]:
+    """Content encodings we can produce, most preferred first."""
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def compress(data: bytes, encoding: str, *, best: bool = False) -> bytes:
+    """
+    Compress `data` with the given content encoding. `best` trades speed for size,
+    which is worthwhile for static files that are only compressed once.
+    """
+    match encoding:
+        case "br":
+            return brotli.compress(data, quality=11 if best else 5)
+        case "gzip":
+            return gzip.compress(data, compresslevel=9 if best else 6)
+    raise ValueError(f"unsupported content encoding {encoding}")
+
+
+class StaticAsset:
+    """A static file held in memory along with its precompressed variants."""
+
+    def __init__(self, name: str, data: bytes):
+        self.name = name
+        self.mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        self.fingerprint = hashlib.sha256(data).hexdigest()[:FINGERPRINT_LENGTH]
+        stem, ext = os.path.splitext(name)
+        self.fingerprinted_name = f"{stem}.{self.fingerprint}{ext}"
+        self.variants = {"identity": data}
+        for encoding in available_encodings():
+            compressed = compress(data, encoding, best=True)
+            if len(compressed) < len(data):
+                self.variants[encoding] = compressed
+
+
+def load_static_assets(folder: str) -> dict[str, StaticAsset]:
+    """
+    Load every file in `folder`, indexed by both its plain and its fingerprinted name.
+    """
+    assets = {}
+    for root, _, files in os.walk(folder):
+        for file in files:
+            path = os.path.join(root, file)
+            name = os.path.relpath(path, folder).replace(os.sep, "/")
+            with open(path, "rb") as f:
+                asset = StaticAsset(name, f.read())
+            assets[asset.name] = asset
+            assets[asset.fingerprinted_name] = asset
+    return assets
+
+
+def static_asset_response(
+    asset: StaticAsset, requested_name: str, request: Request | None = None
+) -> Response:
+    """
+    Serve a static asset in the best encoding the client accepts. Fingerprinted
+    names never change content, so they can be cached forever; plain names are
+    revalidated with their ETag. `request` defaults to Flask's current request.
+    """
+    request = request or current_request
+    encoding = request.accept_encodings.best_match(
+        [e for e in available_encodings() if e in asset.variants], "identity"
+    )
+    response = Response(asset.variants[encoding], mimetype=asset.mimetype)
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    response.set_etag(f"{asset.fingerprint}-{encoding}")
+    if requested_name == asset.fingerprinted_name:
+        response.headers["Cache-Control"] = (
+            f"public, max-age={IMMUTABLE_MAX_AGE}, immutable"
+        )
+    else:
+        response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+
+def compress_response(response: Response, request: Request | None = None) -> Response:
+    """
+    Compress large HTML and JSON responses if the client supports it.
+    Intended to be registered with `app.after_request`, in which case `request`
+    is Flask's current request.
+    """
+    request = request or current_request
+    if (
+        response.direct_passthrough
+        or response.status_code != 200
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+    ):
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = request.accept_encodings.best_match(available_encodings())
+    if encoding is None:
+        return response
+    response.set_data(compress(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
@@ -0,0 +1,235 @@
+"""
+Online backups of the database, taken while the server and updater keep running.
+
+Run from the repository root:
+
+    python backup.py                        # take a snapshot now
+    python backup.py --verify SNAPSHOT      # check a snapshot's checksum
+    python backup.py --restore SNAPSHOT     # replace the database's contents with a snapshot
+"""
+
+import argparse
+import contextlib
+import gzip
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models import BackupStat, migrate
+
+# the database used by the updater and, by default, the server
+DATABASE_PATH = "instance/rss_feeds.db"
+
+# where snapshots are written, and how many of the newest ones are kept
+BACKUP_DIR = "instance/backups"
+BACKUP_KEEP = 7
+
+# gzip snapshots; the database compresses well since it is mostly text
+BACKUP_COMPRESS = True
+
+# the updater takes a snapshot once this long has passed since the last one;
+# None disables scheduled backups
+BACKUP_INTERVAL = timedelta(days=1)
+
+SNAPSHOT_PREFIX = "rss_feeds-"
+CHECKSUM_SUFFIX = ".sha256"
+
+
+def backup_database(source_path: str, dest_path: str) -> int:
+    """
+    Copy a live database with SQLite's online backup API. Returns the number of pages copied.
+
+    The database is in WAL mode (see `models.migrate`), so the copy is made in
+    one step, from a single read transaction: it is consistent, it never has to
+    restart, and writers carry on appending to the WAL in the meantime.
+    """
+    with contextlib.closing(sqlite3.connect(source_path)) as source, contextlib.closing(
+        sqlite3.connect(dest_path)
+    ) as dest:
+        journal_mode = source.execute("PRAGMA journal_mode").fetchone()[0]
+        if journal_mode != "wal":
+            # in the other modes the read lock blocks writers until the copy is done
+            raise ValueError(
+                f"{source_path} is in {journal_mode} mode rather than WAL; migrate it first"
+            )
+        source.backup(dest)
+        # a snapshot is a single file, without a WAL next to it
+        dest.execute("PRAGMA journal_mode=DELETE")
+        return dest.execute("PRAGMA page_count").fetchone()[0]
+
+
+def file_checksum(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def list_snapshots(directory: str = BACKUP_DIR) -> list[str]:
+    """Paths of the snapshots in `directory`, oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.startswith(SNAPSHOT_PREFIX) and not name.endswith(CHECKSUM_SUFFIX)
+    )
+
+
+def rotate_snapshots(directory: str = BACKUP_DIR, keep: int = BACKUP_KEEP):
+    """Remove all but the newest `keep` snapshots."""
+    snapshots = list_snapshots(directory)
+    for path in snapshots[: max(0, len(snapshots) - keep)]:
+        for stale in (path, path + CHECKSUM_SUFFIX):
+            # a concurrent rotation may have removed it already
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(stale)
+
+
+def create_snapshot(
+    db_path: str = DATABASE_PATH,
+    directory: str = BACKUP_DIR,
+    *,
+    compress: bool = BACKUP_COMPRESS,
+    keep: int = BACKUP_KEEP,
+) -> BackupStat:
+    """
+    Back up the database into a new snapshot in `directory`, next to a file with
+    its SHA-256 checksum in the format `sha256sum -c` reads, and rotate old
+    snapshots. Returns the stats of the backup, which the caller should save.
+    """
+    timestamp = datetime.now()
+    start_time = time.time()
+    os.makedirs(directory, exist_ok=True)
+    name = SNAPSHOT_PREFIX + timestamp.strftime("%Y%m%dT%H%M%S") + ".db"
+    if compress:
+        name += ".gz"
+    path = os.path.join(directory, name)
+
+    # nothing is written under the snapshot's own name until it is complete
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    os.close(fd)
+    try:
+        num_pages = backup_database(db_path, tmp_path)
+        size = os.path.getsize(tmp_path)
+        if compress:
+            fd, gz_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+            with open(tmp_path, "rb") as src, os.fdopen(fd, "wb") as raw:
+                with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6) as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.replace(gz_path, tmp_path)
+        checksum = file_checksum(tmp_path)
+        stored_size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+    with open(path + CHECKSUM_SUFFIX, "w") as f:
+        f.write(f"{checksum}  {name}\n")
+    rotate_snapshots(directory, keep)
+
+    return BackupStat(
+        timestamp=timestamp,
+        path=path,
+        num_pages=num_pages,
+        size=size,
+        stored_size=stored_size,
+        checksum=checksum,
+        dur=time.time() - start_time,
+    )
+
+
+def verify_snapshot(path: str) -> bool:
+    """Check a snapshot against its recorded checksum."""
+    try:
+        with open(path + CHECKSUM_SUFFIX) as f:
+            expected = f.read().split()[0]
+    except (FileNotFoundError, IndexError):
+        return False
+    return file_checksum(path) == expected
+
+
+def restore_snapshot(path: str, db_path: str = DATABASE_PATH):
+    """
+    Replace the contents of the database with a snapshot. The snapshot is
+    verified first, and copied in with the backup API in a single step, so
+    connections that are open see either the old or the new database.
+    """
+    if not verify_snapshot(path):
+        raise ValueError(f"{path} does not match its checksum")
+    directory = os.path.dirname(os.path.abspath(db_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".restore-")
+    try:
+        with os.fdopen(fd, "wb") as dst:
+            opener = gzip.open if path.endswith(".gz") else open
+            with opener(path, "rb") as src:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+        with contextlib.closing(sqlite3.connect(tmp_path)) as snapshot:
+            result = snapshot.execute("PRAGMA integrity_check").fetchone()[0]
+            if result != "ok":
+                raise ValueError(f"{path} is corrupt: {result}")
+            with contextlib.closing(sqlite3.connect(db_path)) as dest:
+                snapshot.backup(dest)
+    finally:
+        os.remove(tmp_path)
+
+
+def backup_due(session) -> bool:
+    """Whether a scheduled backup should be taken now."""
+    if BACKUP_INTERVAL is None:
+        return False
+    last = (
+        session.query(BackupStat.timestamp)
+        .order_by(BackupStat.timestamp.desc())
+        .limit(1)
+        .scalar()
+    )
+    return last is None or datetime.now() - last >= BACKUP_INTERVAL
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--database", default=DATABASE_PATH)
+    parser.add_argument("--dir", default=BACKUP_DIR)
+    parser.add_argument("--keep", type=int, default=BACKUP_KEEP)
+    parser.add_argument("--no-compress", action="store_true")
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument("--verify", metavar="SNAPSHOT")
+    action.add_argument("--restore", metavar="SNAPSHOT")
+    args = parser.parse_args()
+
+    if args.verify:
+        ok = verify_snapshot(args.verify)
+        print(f"{args.verify}: {'OK' if ok else 'checksum mismatch'}")
+        raise SystemExit(0 if ok else 1)
+    if args.restore:
+        start_time = time.time()
+        restore_snapshot(args.restore, args.database)
+        print(f"restored {args.restore} in {time.time() - start_time:.2f}s")
+        return
+
+    engine = create_engine(f"sqlite:///{args.database}")
+    migrate(engine)
+    stat = create_snapshot(
+        args.database, args.dir, compress=not args.no_compress, keep=args.keep
+    )
+    print(
+        f"wrote {stat.path} ({stat.size / 2**20:.1f} MiB, "
+        f"{stat.stored_size / 2**20:.1f} MiB stored) in {stat.dur:.2f}s"
+    )
+    with sessionmaker(bind=engine)() as session:
+        session.add(stat)
+        session.commit()
+
+
+if __name__ == "__main__":
+    main()
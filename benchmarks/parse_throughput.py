@@ -0,0 +1,72 @@
+"""
+Measure how feed parsing throughput scales with the number of parse processes.
+
+Run from the repository root:
+
+    python -m benchmarks.parse_throughput --feeds 200 --entries 50
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from email.utils import format_datetime
+
+from parsing import parse_feed
+
+
+def synthetic_feed(index, num_entries):
+    now = datetime.now().astimezone()
+    items = "".join(f"""<item>
+            <title>Feed {index} post {i}</title>
+            <link>https://example.com/{index}/{i}</link>
+            <pubDate>{format_datetime(now - timedelta(hours=i))}</pubDate>
+            <author>author{i}@example.com</author>
+            <description><![CDATA[<p>Paragraph <b>{i}</b> with <a href="/rel/{i}">a link</a>
+            and <img src="https://img.example.com/{i}.png" onerror="alert(1)"/>
+            <script>tracking()</script></p>{'<p>Filler text. </p>' * 20}]]></description>
+        </item>""" for i in range(num_entries))
+    return (
+        f'<?xml version="1.0"?><rss version="2.0"><channel><title>Feed {index}</title>'
+        f"{items}</channel></rss>"
+    ).encode("utf-8")
+
+
+def run(executor, feeds, since):
+    start = time.perf_counter()
+    futures = [executor.submit(parse_feed, body, {}, since) for body in feeds]
+    num_entries = sum(len(f.result()[1]) for f in futures)
+    return time.perf_counter() - start, num_entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--feeds", type=int, default=200)
+    parser.add_argument("--entries", type=int, default=50)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    feeds = [synthetic_feed(i, args.entries) for i in range(args.feeds)]
+    since = datetime.now() - timedelta(days=365)
+    print(f"{args.feeds} feeds x {args.entries} entries, {os.cpu_count()} CPUs")
+
+    with ThreadPoolExecutor(max_workers=args.max_workers) as executor:
+        dur, _ = run(executor, feeds, since)
+    print(f"threads ({args.max_workers}):  {args.feeds / dur:8.1f} feeds/s")
+
+    workers = 1
+    while workers <= args.max_workers:
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            # start the worker processes before timing
+            list(executor.map(int, range(workers)))
+            dur, _ = run(executor, feeds, since)
+        print(f"processes ({workers}): {args.feeds / dur:8.1f} feeds/s")
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""
+Measure the latency of the read path against a database made by `benchmarks.synthetic_db`.
+
+Run from the repository root:
+
+    python -m benchmarks.read_path instance/bench.db --concurrency 1 4 --output baseline.json
+
+Each scenario calls one of the functions in logic.py, or requests one of the
+server's routes through the WSGI app, first one at a time and then from N
+threads at once. For every scenario and concurrency this reports the p50, p95
+and p99 latency, the number of SQL queries per request and the peak memory
+allocated while N requests are in flight. `--output` writes the results as JSON,
+and `--compare` prints the change from a previously written baseline.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import sqlite3
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+# queries issued by the current thread since its counter was last reset
+query_counter = threading.local()
+
+
+def count_queries(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def count(conn, cursor, statement, parameters, context, executemany):
+        query_counter.count = getattr(query_counter, "count", 0) + 1
+
+
+def percentile(quantiles, p):
+    return quantiles[p - 1] if quantiles else None
+
+
+def measure(call, num_requests, concurrency):
+    """Run `call` num_requests times from `concurrency` threads."""
+
+    def timed():
+        query_counter.count = 0
+        start = time.perf_counter()
+        call()
+        return time.perf_counter() - start, query_counter.count
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: timed(), range(num_requests)))
+    wall = time.perf_counter() - start
+    latencies = [dur * 1000 for dur, _ in results]
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else []
+
+    # allocations are traced in a separate pass since tracing slows everything down
+    tracemalloc.start()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(lambda _: call(), range(concurrency)))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "requests": num_requests,
+        "p50_ms": percentile(quantiles, 50) or latencies[0],
+        "p95_ms": percentile(quantiles, 95) or latencies[0],
+        "p99_ms": percentile(quantiles, 99) or latencies[0],
+        "mean_ms": statistics.mean(latencies),
+        "requests_per_s": num_requests / wall,
+        "queries_per_request": statistics.mean(count for _, count in results),
+        "peak_traced_kib": peak / 1024,
+    }
+
+
+def logic_scenarios(engine, args, busiest_feed):
+    import logic
+
+    Session = scoped_session(sessionmaker(bind=engine))
+
+    def scenario(fn):
+        def call():
+            try:
+                fn(Session())
+            finally:
+                # like Flask-SQLAlchemy does at the end of every request
+                Session.remove()
+
+        return call
+
+    deep = args.deep_page * logic.PAGE_SIZE
+    since = datetime.now() - timedelta(days=7)
+    scenarios = {"logic.overview": scenario(logic.overview)}
+    for state in ("all", "visited", "liked"):
+        for offset in (0, deep):
+            scenarios[f"logic.item_list[{state},{offset}]"] = scenario(
+                lambda s, state=state, offset=offset: logic.item_list(
+                    s, state, offset, None
+                )
+            )
+        scenarios[f"logic.item_list[{state},feed]"] = scenario(
+            lambda s, state=state: logic.item_list(s, state, 0, busiest_feed)
+        )
+    scenarios["logic.unvisited_items_after"] = scenario(
+        lambda s: logic.unvisited_items_after(s, since)
+    )
+    for timeframe in ("day", "week", "month"):
+        scenarios[f"logic.fetch_update_stats[{timeframe}]"] = scenario(
+            lambda s, timeframe=timeframe: logic.fetch_update_stats(s, timeframe)
+        )
+    return scenarios
+
+
+def route_scenarios(app, args, busiest_feed):
+    import logic
+
+    clients = threading.local()
+
+    def scenario(url):
+        def call():
+            if not hasattr(clients, "client"):
+                clients.client = app.test_client()
+            response = clients.client.get(url, headers={"Accept-Encoding": "gzip"})
+            if response.status_code != 200:
+                raise RuntimeError(f"GET {url} returned {response.status_code}")
+
+        return call
+
+    deep = args.deep_page * logic.PAGE_SIZE
+    since = (datetime.now() - timedelta(days=7)).isoformat()
+    scenarios = {"GET /": scenario("/")}
+    for state in ("all", "visited", "liked"):
+        for offset in (0, deep):
+            scenarios[f"GET /list?k={state}&offset={offset}"] = scenario(
+                f"/list?k={state}&offset={offset}"
+            )
+        scenarios[f"GET /list?k={state}&feed"] = scenario(
+            f"/list?k={state}&feed={busiest_feed}"
+        )
+    scenarios["GET /api/unvisited"] = scenario(f"/api/unvisited?after={since}")
+    for window in ("day", "week", "month"):
+        scenarios[f"GET /stats?window={window}"] = scenario(f"/stats?window={window}")
+    return scenarios
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    print(f"\nchange in p95 latency from {baseline_path}:")
+    for name, by_concurrency in results.items():
+        for concurrency, result in by_concurrency.items():
+            old = baseline.get(name, {}).get(concurrency)
+            if old is None:
+                continue
+            change = result["p95_ms"] / old["p95_ms"] - 1
+            print(f"  {name:44} c={concurrency:<3} {change:+8.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("path", help="database made by benchmarks.synthetic_db")
+    parser.add_argument("--requests", type=int, default=50, help="per scenario")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4])
+    parser.add_argument(
+        "--deep-page", type=int, default=100, help="page number for deep pagination"
+    )
+    parser.add_argument(
+        "--only", default="", help="run only scenarios whose name contains this"
+    )
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="a JSON file written by an earlier run")
+    args = parser.parse_args()
+    if not os.path.exists(args.path):
+        raise SystemExit(f"{args.path} does not exist")
+
+    # the server binds to its database when it is imported
+    uri = f"sqlite:///{os.path.abspath(args.path)}"
+    os.environ["RSRSSR_DATABASE_URI"] = uri
+    from server import app, db
+
+    engine = create_engine(uri)
+    with app.app_context():
+        count_queries(db.engine)
+    count_queries(engine)
+    with engine.connect() as conn:
+        num_feeds, num_items = conn.execute(
+            text("SELECT (SELECT COUNT(*) FROM feed), (SELECT COUNT(*) FROM item)")
+        ).one()
+        busiest_feed = conn.execute(
+            text(
+                "SELECT feed_id FROM item GROUP BY feed_id ORDER BY COUNT(*) DESC LIMIT 1"
+            )
+        ).scalar()
+
+    scenarios = logic_scenarios(engine, args, busiest_feed)
+    scenarios.update(route_scenarios(app, args, busiest_feed))
+    print(
+        f"{num_items} items in {num_feeds} feeds, {args.requests} requests per scenario"
+    )
+    results = {}
+    for name, call in scenarios.items():
+        if args.only not in name:
+            continue
+        # warm up caches (SQLite's page cache, templates) before timing
+        call()
+        results[name] = {}
+        for concurrency in args.concurrency:
+            result = measure(call, args.requests, concurrency)
+            results[name][str(concurrency)] = result
+            print(
+                f"  {name:44} c={concurrency:<3} "
+                f"p50 {result['p50_ms']:8.2f}ms  p95 {result['p95_ms']:8.2f}ms  "
+                f"p99 {result['p99_ms']:8.2f}ms  "
+                f"{result['queries_per_request']:5.1f} queries  "
+                f"{result['peak_traced_kib']:8.0f}KiB"
+            )
+
+    report = {
+        "timestamp": datetime.now().isoformat(),
+        "python": sys.version.split()[0],
+        "sqlite_version": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "database": {"feeds": num_feeds, "items": num_items},
+        # ru_maxrss is in KiB on Linux
+        "max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
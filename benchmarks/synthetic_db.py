@@ -0,0 +1,253 @@
+"""
+Generate a synthetic database shaped like one that has been in use for a long time.
+
+Run from the repository root:
+
+    python -m benchmarks.synthetic_db instance/bench.db --feeds 500 --items 2000000
+
+Feeds post at very different rates, most items are recent, and older items have
+mostly been read or dismissed. The database has the same schema and indexes as a
+real one, so the server and `benchmarks.read_path` can be pointed at it.
+"""
+
+import argparse
+import math
+import os
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+
+from models import Base, Item, migrate
+
+# SQLAlchemy's storage format for DateTime columns in SQLite
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+# number of rows inserted per executemany
+CHUNK_SIZE = 50_000
+
+
+def format_datetime(value):
+    return value.strftime(DATETIME_FORMAT) if value is not None else None
+
+
+def feed_rows(args, rng, now):
+    for feed_id in range(1, args.feeds + 1):
+        yield (
+            feed_id,
+            f"https://feeds.example.com/{feed_id}/rss",
+            f"Feed {feed_id}",
+            format_datetime(now - timedelta(minutes=rng.random() * 60)),
+            format_datetime(now - timedelta(minutes=rng.random() * 60)),
+            rng.random() < args.downrank,
+        )
+
+
+def item_rows(args, rng, now):
+    # a few feeds post far more than the rest
+    weights = [rng.paretovariate(1.2) for _ in range(args.feeds)]
+    cum_weights = []
+    total = 0.0
+    for weight in weights:
+        total += weight
+        cum_weights.append(total)
+    feed_ids = range(1, args.feeds + 1)
+
+    # ids increase with publication date, as they do when items are ingested over time
+    ages = sorted(
+        (args.days * rng.random() ** args.skew for _ in range(args.items)),
+        reverse=True,
+    )
+    # new items are less likely to have been read or dismissed yet; the chance is
+    # scaled so that the overall ratios still match the ones asked for
+    age_factors = [1 - math.exp(-age / args.unread_days) for age in ages]
+    mean_age_factor = sum(age_factors) / len(age_factors) if ages else 1
+    description = (
+        "<p>" + "Lorem ipsum dolor sit amet. " * (args.description // 28) + "</p>"
+    )
+    for item_id, (age, age_factor) in enumerate(zip(ages, age_factors), start=1):
+        published = now - timedelta(days=age)
+        age_factor /= mean_age_factor
+        visited = liked = dismissed = None
+        roll = rng.random()
+        if roll < args.read * age_factor:
+            visited = min(now, published + timedelta(hours=rng.expovariate(1 / 12)))
+            if rng.random() < args.like / args.read:
+                liked = visited
+        elif roll < (args.read + args.dismiss) * age_factor:
+            dismissed = min(now, published + timedelta(hours=rng.expovariate(1 / 24)))
+        canonical_id = None
+        if item_id > 1 and rng.random() < args.duplicates:
+            # copies of an article appear in other feeds around the same time
+            canonical_id = rng.randint(max(1, item_id - 1000), item_id - 1)
+        yield (
+            item_id,
+            f"Item {item_id}",
+            f"https://example.com/articles/{item_id}",
+            format_datetime(published),
+            description,
+            f"author{item_id % 997}@example.com",
+            format_datetime(visited),
+            format_datetime(liked),
+            format_datetime(dismissed),
+            rng.choices(feed_ids, cum_weights=cum_weights)[0],
+            canonical_id,
+        )
+
+
+def update_stat_rows(args, rng, now):
+    for hour in range(args.stats_days * 24):
+        num_fetched = args.feeds - rng.randint(0, max(1, args.feeds // 50))
+        avg = rng.uniform(100, 400)
+        yield (
+            format_datetime(now - timedelta(hours=hour)),
+            "bench",
+            args.feeds,
+            num_fetched,
+            rng.randint(0, num_fetched // 4),
+            args.feeds - num_fetched,
+            rng.randint(0, 200),
+            rng.uniform(5, 60),
+            rng.uniform(10, 50),
+            rng.randint(1, args.feeds),
+            avg,
+            avg / 2,
+            rng.uniform(2000, 30000),
+            rng.randint(1, args.feeds),
+        )
+
+
+def insert(conn, table, columns, rows):
+    statement = (
+        f"INSERT INTO {table} ({', '.join(columns)}) "
+        f"VALUES ({', '.join('?' * len(columns))})"
+    )
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            conn.executemany(statement, chunk)
+            chunk.clear()
+    conn.executemany(statement, chunk)
+
+
+def generate(args):
+    if os.path.exists(args.path):
+        raise SystemExit(f"{args.path} already exists")
+    rng = random.Random(args.seed)
+    now = datetime.now()
+    engine = create_engine(f"sqlite:///{args.path}")
+    Base.metadata.create_all(engine)
+    engine.dispose()
+
+    conn = sqlite3.connect(args.path)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    # loading into unindexed tables and indexing afterwards is much faster;
+    # migrate() below creates the indexes again
+    for index in Item.__table__.indexes:
+        conn.execute(f"DROP INDEX {index.name}")
+    with conn:
+        insert(
+            conn,
+            "feed",
+            ["id", "url", "title", "last_updated", "last_fetched", "downrank"],
+            feed_rows(args, rng, now),
+        )
+        insert(
+            conn,
+            "item",
+            [
+                "id",
+                "title",
+                "link",
+                "published",
+                "description",
+                "author",
+                "visited",
+                "liked",
+                "dismissed",
+                "feed_id",
+                "canonical_id",
+            ],
+            item_rows(args, rng, now),
+        )
+        insert(
+            conn,
+            "update_stats",
+            [
+                "timestamp",
+                "instance",
+                "num_feeds",
+                "num_fetched",
+                "num_updated",
+                "num_failed",
+                "num_new_items",
+                "dur_total",
+                "dur_min_feed",
+                "dur_min_feed_id",
+                "dur_avg_feed",
+                "dur_std_feed",
+                "dur_max_feed",
+                "dur_max_feed_id",
+            ],
+            update_stat_rows(args, rng, now),
+        )
+    conn.close()
+
+    engine = create_engine(f"sqlite:///{args.path}")
+    migrate(engine)
+    engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("path", help="database file to create")
+    parser.add_argument("--feeds", type=int, default=500)
+    parser.add_argument("--items", type=int, default=2_000_000)
+    parser.add_argument(
+        "--days", type=float, default=3 * 365, help="age of the oldest items"
+    )
+    parser.add_argument(
+        "--skew",
+        type=float,
+        default=2.0,
+        help="how strongly items cluster around the present (1 is uniform)",
+    )
+    parser.add_argument(
+        "--unread-days",
+        type=float,
+        default=7.0,
+        help="how many days it takes to catch up with most new items",
+    )
+    parser.add_argument("--read", type=float, default=0.6, help="fraction visited")
+    parser.add_argument("--like", type=float, default=0.02, help="fraction liked")
+    parser.add_argument(
+        "--dismiss", type=float, default=0.15, help="fraction dismissed"
+    )
+    parser.add_argument(
+        "--duplicates", type=float, default=0.05, help="fraction that are copies"
+    )
+    parser.add_argument("--downrank", type=float, default=0.1)
+    parser.add_argument(
+        "--description", type=int, default=300, help="bytes per description"
+    )
+    parser.add_argument("--stats-days", type=int, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if not 0 < args.like <= args.read or args.read + args.dismiss > 1:
+        parser.error("ratios must satisfy 0 < like <= read and read + dismiss <= 1")
+
+    start = time.perf_counter()
+    generate(args)
+    size = os.path.getsize(args.path)
+    print(
+        f"generated {args.items} items in {args.feeds} feeds in "
+        f"{time.perf_counter() - start:.1f}s ({size / 2**20:.0f} MiB)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import hashlib
+import io
+import contextlib
+import os
+import re
+import tempfile
+import urllib.request
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# rewrite images in item descriptions to be served through `/img` when items are ingested
+PROXY_IMAGES = False
+
+# where proxied images are stored, and how large the cache may grow before
+# the least recently used images are evicted
+IMAGE_CACHE_DIR = "instance/image_cache"
+IMAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# images wider or taller than this are downscaled, if Pillow is installed
+IMAGE_MAX_DIMENSION = 1200
+
+# images larger than this are not proxied at all
+IMAGE_MAX_DOWNLOAD_BYTES = 20 * 1024 * 1024
+
+# seconds to wait for an image server before giving up
+IMAGE_FETCH_TIMEOUT = 15
+
+# how long browsers may cache proxied images for; a key always maps to the same image
+IMAGE_MAX_AGE = 365 * 24 * 60 * 60
+
+# magic bytes of the image formats we are willing to serve from our own origin.
+# SVG is deliberately absent since it can contain scripts.
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+    (b"\x00\x00\x01\x00", "image/x-icon"),
+]
+
+# keys are sha256 hex digests of the image URL, and name the cached files
+IMAGE_KEY_RE = re.compile(r"[0-9a-f]{64}")
+
+IMG_TAG_RE = re.compile(r"<img\b[^>]*>", re.IGNORECASE)
+IMG_SRC_RE = re.compile(r"""(\s(src|srcset)\s*=\s*)(["'])(.*?)\3""", re.IGNORECASE)
+
+
+def image_key(url: str) -> str:
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+def is_image_key(key: str) -> bool:
+    """Whether `key` could be an image key, and so is safe to use as a file name."""
+    return IMAGE_KEY_RE.fullmatch(key) is not None
+
+
+def sniff_image_type(data: bytes) -> str | None:
+    """Return the mimetype of an image in an allowed format, or None."""
+    for signature, mimetype in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return mimetype
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:12] in (b"ftypavif", b"ftypavis"):
+        return "image/avif"
+    return None
+
+
+def rewrite_image_urls(html: str | None) -> tuple[str | None, dict[str, str]]:
+    """
+    Point every remote `<img>` in `html` at the local proxy.
+    Returns the rewritten HTML and the proxied URLs by key.
+    """
+    images = {}
+    if not html:
+        return html, images
+
+    def proxy_url(url):
+        if not url.startswith(("http://", "https://")):
+            return url
+        key = image_key(url)
+        images[key] = url
+        return f"/img/{key}"
+
+    def rewrite_attribute(match):
+        prefix, attribute, quote, value = match.groups()
+        if attribute.lower() == "srcset":
+            candidates = []
+            for candidate in value.split(","):
+                if not candidate.strip():
+                    continue
+                url, *descriptor = candidate.split()
+                candidates.append(" ".join([proxy_url(url), *descriptor]))
+            value = ", ".join(candidates)
+        else:
+            value = proxy_url(value)
+        return f"{prefix}{quote}{value}{quote}"
+
+    def rewrite_tag(match):
+        return IMG_SRC_RE.sub(rewrite_attribute, match.group(0))
+
+    return IMG_TAG_RE.sub(rewrite_tag, html), images
+
+
+def downscale(data: bytes, mimetype: str) -> bytes:
+    """Shrink large still images so they fit within IMAGE_MAX_DIMENSION."""
+    if Image is None or mimetype not in ("image/jpeg", "image/png", "image/webp"):
+        return data
+    with Image.open(io.BytesIO(data)) as image:
+        if max(image.size) <= IMAGE_MAX_DIMENSION:
+            return data
+        image.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION))
+        out = io.BytesIO()
+        image.save(out, format=image.format or mimetype.split("/")[1], quality=85)
+    return out.getvalue() if out.tell() < len(data) else data
+
+
+class ImageCache:
+    """
+    A disk cache of proxied images, one file per key. A file's modification time
+    is its last use, so the least recently used images are evicted first.
+    """
+
+    def __init__(
+        self,
+        directory: str = IMAGE_CACHE_DIR,
+        max_bytes: int = IMAGE_CACHE_MAX_BYTES,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, key: str) -> str:
+        if not is_image_key(key):
+            raise ValueError(f"not an image key: {key!r}")
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str) -> tuple[bytes, str] | None:
+        """Return a cached image and its mimetype, marking it as recently used."""
+        try:
+            with open(self.path(key), "rb") as f:
+                data = f.read()
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            return None
+        mimetype = sniff_image_type(data)
+        return None if mimetype is None else (data, mimetype)
+
+    def fetch(self, key: str, url: str) -> tuple[bytes, str] | None:
+        """
+        Return the image at `url`, downloading and caching it if necessary.
+        Returns None if the URL does not point at an image we can serve.
+        """
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        request = urllib.request.Request(url, headers={"User-Agent": "rsrssr"})
+        with urllib.request.urlopen(request, timeout=IMAGE_FETCH_TIMEOUT) as response:
+            data = response.read(IMAGE_MAX_DOWNLOAD_BYTES + 1)
+        mimetype = sniff_image_type(data)
+        if mimetype is None or len(data) > IMAGE_MAX_DOWNLOAD_BYTES:
+            return None
+        data = downscale(data, mimetype)
+        # created on first use, so that merely importing the server creates nothing
+        os.makedirs(self.directory, exist_ok=True)
+        # write to a temporary file first so that concurrent readers never see a partial image
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path(key))
+        self.evict()
+        return data, mimetype
+
+    def evict(self):
+        """Remove the least recently used images until the cache fits in max_bytes."""
+        entries = [
+            entry
+            for entry in os.scandir(self.directory)
+            if entry.is_file() and not entry.name.startswith(".tmp-")
+        ]
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+            if total <= self.max_bytes:
+                break
+            total -= entry.stat().st_size
+            # another process may have evicted it already
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(entry.path)
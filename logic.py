@@ -1,5 +1,6 @@
 from typing import Any, Literal
 import time
+import threading
 import math
 import sqlalchemy
 
@@ -7,10 +8,12 @@ import datetime
 import pandas as pd
 
 from sqlalchemy.orm import scoped_session, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
 
 from update import update_feed
 
-from models import Item, Feed, UpdateStat
+from models import BackupStat, Item, ItemFingerprint, Feed, UpdateStat
+from visit_log import VisitLog, log_path
 
 # number of items per page
 PAGE_SIZE = 48
@@ -28,6 +31,12 @@ def last_update_stats(session: scoped_session) -> UpdateStat | None:
     return last_stats
 
 
+def last_backup_stats(session: scoped_session) -> BackupStat | None:
+    return (
+        session.query(BackupStat).order_by(BackupStat.timestamp.desc()).limit(1).first()
+    )
+
+
 def item_list(
     session: scoped_session,
     state: Literal["visited"] | Literal["liked"] | Literal["all"],
@@ -35,19 +44,22 @@ def item_list(
     specific_feed_id: int | None,
 ) -> dict[str, Any]:
     start_time = time.time()
+    pending = pending_visits(session)
+    visited = visited_column(pending)
 
     items_query = session.query(Item)
 
     if specific_feed_id:
         items_query = items_query.where(Item.feed_id == specific_feed_id)
+    else:
+        # only show one copy of items that were published by several feeds
+        items_query = items_query.where(Item.canonical_id == None)
 
     match state:
         case "all":
             pass
         case "visited":
-            items_query = items_query.where(Item.visited != None).order_by(
-                Item.visited.desc()
-            )
+            items_query = items_query.where(visited != None).order_by(visited.desc())
         case "liked":
             items_query = items_query.where(Item.liked != None).order_by(
                 Item.liked.desc()
@@ -59,6 +71,11 @@ def item_list(
         .limit(PAGE_SIZE)
         .all()
     )
+    for item in items:
+        when = pending.get(item.canonical_id or item.id)
+        if when is not None:
+            # shown as visited without writing to the database
+            set_committed_value(item, "visited", when)
 
     last_stats = last_update_stats(session)
 
@@ -87,13 +104,14 @@ OVERVIEW_ITEMS_PER_FEED = 7
 
 def overview(session: scoped_session) -> dict[str, Any]:
     start_time = time.time()
+    pending = pending_visits(session)
 
     since_date = datetime.datetime.now() - datetime.timedelta(
         days=OVERVIEW_NUM_DAYS_SINCE
     )
 
     # Subquery to get the maximum published date and count of items for each feed
-    # Exclude visited or dismissed items from overview
+    # Exclude visited or dismissed items and duplicates of other items from overview
     subquery = (
         session.query(
             Item.feed_id,
@@ -102,8 +120,9 @@ def overview(session: scoped_session) -> dict[str, Any]:
         )
         .filter(
             Item.published >= since_date,
-            Item.visited == None,
+            unvisited(pending),
             Item.dismissed == None,
+            Item.canonical_id == None,
         )
         .group_by(Item.feed_id)
         .subquery()
@@ -120,14 +139,15 @@ def overview(session: scoped_session) -> dict[str, Any]:
     items_by_feed = []
 
     for feed in feeds_with_max:
-        # Fetch recent items excluding visited or dismissed
+        # Fetch recent items excluding visited, dismissed or duplicates
         recent_items = (
             session.query(Item)
             .filter(
                 Item.feed_id == feed.id,
                 Item.published >= since_date,
-                Item.visited == None,
+                unvisited(pending),
                 Item.dismissed == None,
+                Item.canonical_id == None,
             )
             .order_by(Item.published.desc())
             .limit(OVERVIEW_ITEMS_PER_FEED)
@@ -170,6 +190,42 @@ def add_feed(session: scoped_session, url: str):
 
 def delete_feed(session: scoped_session, id: int):
     feed = session.query(Feed).get(id)
+    feed_items = sqlalchemy.select(Item.id).where(Item.feed_id == id)
+    # items from other feeds that are copies of this feed's items need a new
+    # canonical item: the first copy of each, which the other copies then point at
+    promoted = (
+        sqlalchemy.select(
+            Item.canonical_id.label("old_id"),
+            sqlalchemy.func.min(Item.id).label("new_id"),
+        )
+        .where(Item.canonical_id.in_(feed_items), Item.feed_id != id)
+        .group_by(Item.canonical_id)
+        .subquery()
+    )
+    no_sync = {"synchronize_session": False}
+    # the fingerprints move first, since promoting the copies changes `promoted`
+    session.execute(
+        sqlalchemy.update(ItemFingerprint)
+        .where(ItemFingerprint.item_id == promoted.c.old_id)
+        .values(item_id=promoted.c.new_id),
+        execution_options=no_sync,
+    )
+    session.execute(
+        sqlalchemy.update(Item)
+        .where(Item.canonical_id == promoted.c.old_id, Item.feed_id != id)
+        .values(
+            canonical_id=sqlalchemy.case(
+                (Item.id == promoted.c.new_id, None), else_=promoted.c.new_id
+            )
+        ),
+        execution_options=no_sync,
+    )
+    session.execute(
+        sqlalchemy.delete(ItemFingerprint).where(
+            ItemFingerprint.item_id.in_(feed_items)
+        ),
+        execution_options=no_sync,
+    )
     session.delete(feed)
     session.commit()
 
@@ -202,7 +258,7 @@ def fetch_update_stats(session: scoped_session, timeframe: str) -> pd.DataFrame:
         "week": "-7 days",
         "month": "-1 month",
     }.get(timeframe)
-    return pd.read_sql_query(
+    data = pd.read_sql_query(
         f"""
         SELECT
         update_stats.*,
@@ -215,25 +271,212 @@ def fetch_update_stats(session: scoped_session, timeframe: str) -> pd.DataFrame:
     """,
         con=session.connection(),
     )
+    return merge_instance_stats(data)
+
+
+# stats recorded by different updater instances within this window are one run
+STATS_MERGE_WINDOW = "1h"
+
+
+def merge_instance_stats(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Combine the stats that several updater instances recorded for the same run
+    into one row: counts are summed, per-feed durations are pooled, and the run
+    took as long as its slowest instance.
+    """
+    if data.empty:
+        return data.assign(num_instances=pd.Series(dtype=int))
+    data = data.assign(
+        timestamp=pd.to_datetime(data["timestamp"]),
+        instance=data["instance"].fillna(""),
+    )
+    window = data["timestamp"].dt.floor(STATS_MERGE_WINDOW)
+    # an instance that ran twice in one window recorded two separate runs
+    run = data.groupby([window, data["instance"]]).cumcount()
+    data = data.assign(run_key=data.groupby([window, run]).ngroup())
+
+    n = data["num_fetched"]
+    total = n.groupby(data["run_key"]).transform("sum")
+    avg = (n * data["dur_avg_feed"]).groupby(data["run_key"]).transform(
+        "sum"
+    ) / total.where(total > 0)
+    # pooled variance: the spread within each instance plus between instances
+    squares = (n - 1).clip(lower=0) * data["dur_std_feed"] ** 2 + n * (
+        data["dur_avg_feed"] - avg
+    ) ** 2
+    var = squares.groupby(data["run_key"]).transform("sum") / (total - 1).where(
+        total > 1
+    )
+    data = data.assign(
+        dur_avg_feed=avg.fillna(0.0), dur_std_feed=var.fillna(0.0) ** 0.5
+    )
+
+    # the fastest and slowest feeds come from instances that fetched anything
+    idle = n == 0
+    fastest = (
+        data.assign(idle=idle)
+        .sort_values(["idle", "dur_min_feed"])
+        .drop_duplicates("run_key")
+        .set_index("run_key")
+    )
+    slowest = (
+        data.assign(idle=idle)
+        .sort_values(["idle", "dur_max_feed"], ascending=[True, False])
+        .drop_duplicates("run_key")
+        .set_index("run_key")
+    )
+    merged = data.groupby("run_key").agg(
+        timestamp=("timestamp", "min"),
+        num_instances=("timestamp", "size"),
+        num_feeds=("num_feeds", "max"),
+        num_fetched=("num_fetched", "sum"),
+        num_updated=("num_updated", "sum"),
+        num_failed=("num_failed", "sum"),
+        num_new_items=("num_new_items", "sum"),
+        dur_total=("dur_total", "max"),
+        dur_avg_feed=("dur_avg_feed", "first"),
+        dur_std_feed=("dur_std_feed", "first"),
+        bytes_received=("bytes_received", "sum"),
+        bytes_decoded=("bytes_decoded", "sum"),
+        bytes_saved=("bytes_saved", "sum"),
+    )
+    merged = merged.join(
+        fastest[["dur_min_feed", "dur_min_feed_id", "min_feed_url"]]
+    ).join(slowest[["dur_max_feed", "dur_max_feed_id", "max_feed_url"]])
+    return merged.sort_values("timestamp", ignore_index=True)
 
 
 import datetime
 
 
-def record_visit(session: scoped_session, item_id: int):
-    item = session.query(Item).get(item_id)
-    if item:
-        item.visited = datetime.datetime.now()
-    session.commit()
+def set_on_all_copies(session: scoped_session, item_id: int, **values):
+    """
+    Update an item and every copy of it from other feeds in a single statement.
+    """
+    canonical_id = (
+        session.query(Item.canonical_id).filter(Item.id == item_id).scalar() or item_id
+    )
+    session.execute(
+        sqlalchemy.update(Item)
+        .where(
+            sqlalchemy.or_(Item.id == canonical_id, Item.canonical_id == canonical_id)
+        )
+        .values(**values)
+    )
+
+
+# how often the server writes logged visits to the database, in seconds
+VISIT_FLUSH_INTERVAL = 2.0
+
+# the visit log of each database file by its path, and of each in-memory database by engine
+visit_logs: dict[Any, VisitLog] = {}
+visit_logs_lock = threading.Lock()
+
+# the item that visits to an item (or any copy of it) are written to
+canonical_item_id = sqlalchemy.func.coalesce(Item.canonical_id, Item.id)
+
+
+def visit_log(bind) -> VisitLog:
+    """The visit log of the database a session or engine is bound to."""
+    engine = bind.get_bind() if hasattr(bind, "get_bind") else bind
+    database = engine.url.database
+    if not database or database == ":memory:":
+        key, path = engine, None
+    else:
+        key = path = log_path(database)
+    with visit_logs_lock:
+        if key not in visit_logs:
+            visit_logs[key] = VisitLog(path)
+        return visit_logs[key]
+
+
+def record_visit(bind, item_id: int):
+    """
+    Log a visit to be written by the next `flush_visits`, so that a burst of
+    visits (e.g. opening many tabs) becomes a single write transaction. Takes
+    the session or engine of the database, but never touches the database.
+    """
+    visit_log(bind).append(item_id, datetime.datetime.now())
+
+
+def canonical_visits(
+    session: scoped_session, visits: dict[int, datetime.datetime]
+) -> dict[int, datetime.datetime]:
+    """
+    Visits by the id of the canonical item of the visited item, dropping visits
+    to items that no longer exist. If several copies were visited, the latest wins.
+    """
+    if not visits:
+        return {}
+    canonical_ids = dict(
+        session.query(Item.id, canonical_item_id).filter(Item.id.in_(visits)).all()
+    )
+    visited = {}
+    for item_id, when in visits.items():
+        if item_id in canonical_ids:
+            key = canonical_ids[item_id]
+            visited[key] = max(when, visited.get(key, when))
+    return visited
+
+
+def pending_visits(session: scoped_session) -> dict[int, datetime.datetime]:
+    """Logged visits that are not written yet, by canonical item id, for reads to overlay."""
+    return canonical_visits(session, visit_log(session).read())
+
+
+def visited_column(pending: dict[int, datetime.datetime]):
+    """`Item.visited`, with the pending visits overlaid."""
+    if not pending:
+        return Item.visited
+    return sqlalchemy.case(pending, value=canonical_item_id, else_=Item.visited)
+
+
+def unvisited(pending: dict[int, datetime.datetime]):
+    """
+    A filter for items that are neither visited nor have a pending visit,
+    for queries that only select canonical items.
+    """
+    if not pending:
+        return Item.visited == None
+    return sqlalchemy.and_(Item.visited == None, Item.id.not_in(pending))
+
+
+def flush_visits(session: scoped_session):
+    """
+    Write the logged visits with one UPDATE, propagating each visit to every
+    copy of the item, and cut them from the log. If the write fails the log is
+    kept for the next flush; if another process is flushing, this does nothing.
+    """
+    with visit_log(session).flushing() as visits:
+        if not visits:
+            return
+        try:
+            visited = canonical_visits(session, visits)
+            if visited:
+                session.execute(
+                    sqlalchemy.update(Item)
+                    .where(
+                        sqlalchemy.or_(
+                            Item.id.in_(visited), Item.canonical_id.in_(visited)
+                        )
+                    )
+                    .values(visited=visited_column(visited))
+                )
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
 
 
 def toggle_like(session: scoped_session, item_id: int):
     item = session.query(Item).get(item_id)
     if item:
-        if item.liked is None:
-            item.liked = datetime.datetime.now()
-        else:
-            item.liked = None
+        # liked on every copy, since listings of all feeds only show the first one
+        set_on_all_copies(
+            session,
+            item_id,
+            liked=datetime.datetime.now() if item.liked is None else None,
+        )
     session.commit()
 
 
@@ -241,21 +484,20 @@ def record_dismiss(session: scoped_session, item_id: int):
     """
     Mark the given item as dismissed by setting its dismissed timestamp.
     """
-    item = session.query(Item).get(item_id)
-    if item:
-        item.dismissed = datetime.datetime.now()
+    set_on_all_copies(session, item_id, dismissed=datetime.datetime.now())
     session.commit()
 
 
 def unvisited_items_after(session: scoped_session, since_date: datetime.datetime):
-    """Return unvisited and not dismissed items newer than ``since_date``."""
+    """Return unvisited, not dismissed and not duplicated items newer than ``since_date``."""
     return (
         session.query(Item)
         .options(joinedload(Item.feed))
         .filter(
             Item.published >= since_date,
-            Item.visited == None,
+            unvisited(pending_visits(session)),
             Item.dismissed == None,
+            Item.canonical_id == None,
         )
         .order_by(Item.published.desc())
         .all()
@@ -7,8 +7,12 @@ from sqlalchemy import (
     Text,
     DateTime,
     ForeignKey,
+    Index,
+    LargeBinary,
+    text,
 )
 from sqlalchemy.orm import relationship, declarative_base
+from sqlalchemy.schema import CreateIndex, CreateTable
 
 Base = declarative_base()
 
@@ -20,11 +24,83 @@ class Feed(Base):
     title = Column(String(256), nullable=True)
     etag = Column(String(128), nullable=True)
     modified = Column(String(128), nullable=True)
-    last_updated = Column(DateTime, nullable=True)
+    # hash of the last downloaded document, to skip parsing it again if it is unchanged
+    content_hash = Column(String(64), nullable=True)
+    last_updated = Column(DateTime, nullable=True, index=True)
+    # when an updater last tried to fetch the feed, whether or not it had changed
+    last_fetched = Column(DateTime, nullable=True, index=True)
+    # size of the last full document after decoding, which a 304 or a delta saved downloading
+    document_size = Column(Integer, nullable=True)
+    # bytes downloaded for the feed over all fetches, as sent and after decoding
+    bytes_received = Column(Integer, nullable=True)
+    bytes_decoded = Column(Integer, nullable=True)
     downrank = Column(Boolean, nullable=False, default=False)
     items = relationship(
         "Item", backref="feed", lazy=True, cascade="all, delete-orphan"
     )
+    lease = relationship(
+        "FeedLease", uselist=False, lazy=True, cascade="all, delete-orphan"
+    )
+    websub = relationship(
+        "WebSubSubscription", uselist=False, lazy=True, cascade="all, delete-orphan"
+    )
+    pushes = relationship(
+        "WebSubPush",
+        lazy=True,
+        cascade="all, delete-orphan",
+        order_by="WebSubPush.id",
+    )
+
+
+class FeedLease(Base):
+    """
+    Which updater instance is currently fetching a feed, so that several
+    instances can share the feeds without fetching any of them twice.
+    A lease that has expired can be claimed by another instance.
+    """
+
+    __tablename__ = "feed_lease"
+    feed_id = Column(Integer, ForeignKey("feed.id"), primary_key=True)
+    owner = Column(String(128), nullable=True)
+    expires = Column(DateTime, nullable=True)
+
+
+class WebSubSubscription(Base):
+    """
+    A subscription to the WebSub hub a feed advertises, which pushes the feed's
+    new entries to the server's callback. `expires` is only set once the hub
+    has verified the subscription, and is when the hub will stop pushing.
+    """
+
+    __tablename__ = "websub_subscription"
+    feed_id = Column(Integer, ForeignKey("feed.id"), primary_key=True)
+    hub = Column(String(512), nullable=False)
+    topic = Column(String(512), nullable=False)
+    # shared with the hub to sign the content it pushes
+    secret = Column(String(64), nullable=False)
+    # when a subscription request was last sent to the hub
+    requested = Column(DateTime, nullable=True)
+    expires = Column(DateTime, nullable=True)
+    # when the hub last refused the subscription
+    denied = Column(DateTime, nullable=True)
+
+
+class WebSubPush(Base):
+    """
+    Content a hub pushed while an updater held the feed's lease, which the
+    updater adds to the feed before it gives up the lease.
+    """
+
+    __tablename__ = "websub_push"
+    id = Column(Integer, primary_key=True)
+    feed_id = Column(Integer, ForeignKey("feed.id"), nullable=False, index=True)
+    received = Column(DateTime, nullable=False)
+    content_type = Column(String(256), nullable=True)
+    body = Column(LargeBinary, nullable=False)
+
+
+# items that are shown as new: not read, dismissed or a duplicate of another item
+UNREAD = "visited IS NULL AND dismissed IS NULL AND canonical_id IS NULL"
 
 
 class Item(Base):
@@ -32,18 +108,94 @@ class Item(Base):
     id = Column(Integer, primary_key=True)
     title = Column(String(256), nullable=False)
     link = Column(String(512), nullable=False)
-    published = Column(DateTime, nullable=False, index=True)
+    published = Column(DateTime, nullable=False)
     description = Column(Text, nullable=True)
     author = Column(String(128), nullable=True)
-    visited = Column(DateTime, nullable=True, index=True)
-    liked = Column(DateTime, nullable=True, index=True)
-    dismissed = Column(DateTime, nullable=True, index=True)
-    feed_id = Column(Integer, ForeignKey("feed.id"), nullable=False, index=True)
+    visited = Column(DateTime, nullable=True)
+    liked = Column(DateTime, nullable=True)
+    dismissed = Column(DateTime, nullable=True)
+    feed_id = Column(Integer, ForeignKey("feed.id"), nullable=False)
+    # set when this item is a copy of an item already ingested from another feed
+    canonical_id = Column(Integer, ForeignKey("item.id"), nullable=True)
+
+    # Each index serves specific queries in logic.py/update.py, which
+    # tests/test_query_plans.py checks. Partial indexes keep SQLite from using an
+    # index on e.g. `visited` to answer `visited IS NULL`, which matches most rows.
+    __table_args__ = (
+        # items of one feed, newest first (feed pages, high-water mark in updates)
+        Index("ix_item_feed_published", "feed_id", "published"),
+        # all items except duplicates, newest first
+        Index(
+            "ix_item_canonical_published",
+            "published",
+            sqlite_where=text("canonical_id IS NULL"),
+        ),
+        # unread items per feed (overview) and across all feeds (/api/unvisited)
+        Index(
+            "ix_item_unread_feed_published",
+            "feed_id",
+            "published",
+            sqlite_where=text(UNREAD),
+        ),
+        Index("ix_item_unread_published", "published", sqlite_where=text(UNREAD)),
+        # visited and liked items, across all feeds and per feed
+        Index(
+            "ix_item_visited_published",
+            "visited",
+            "published",
+            sqlite_where=text("visited IS NOT NULL"),
+        ),
+        Index(
+            "ix_item_feed_visited_published",
+            "feed_id",
+            "visited",
+            "published",
+            sqlite_where=text("visited IS NOT NULL"),
+        ),
+        Index(
+            "ix_item_liked_published",
+            "liked",
+            "published",
+            sqlite_where=text("liked IS NOT NULL"),
+        ),
+        Index(
+            "ix_item_feed_liked_published",
+            "feed_id",
+            "liked",
+            "published",
+            sqlite_where=text("liked IS NOT NULL"),
+        ),
+        # copies of an item, for propagating visits and dismissals
+        Index(
+            "ix_item_copies",
+            "canonical_id",
+            sqlite_where=text("canonical_id IS NOT NULL"),
+        ),
+    )
+
+
+class ItemFingerprint(Base):
+    """Maps the fingerprint of an item's normalized link/content to the canonical item."""
+
+    __tablename__ = "item_fingerprint"
+    fingerprint = Column(String(64), primary_key=True)
+    item_id = Column(Integer, ForeignKey("item.id"), nullable=False, index=True)
+
+
+class ProxiedImage(Base):
+    """An image referenced by an item description, served through the `/img` proxy."""
+
+    __tablename__ = "proxied_image"
+    key = Column(String(64), primary_key=True)
+    url = Column(Text, nullable=False)
 
 
 class UpdateStat(Base):
     __tablename__ = "update_stats"
     timestamp = Column(DateTime, nullable=False, primary_key=True)
+    # the updater instance that recorded these stats, since instances started at
+    # the same time record stats with the same timestamp; "" in older stats
+    instance = Column(String(128), nullable=False, primary_key=True, default="")
     num_feeds = Column(Integer, nullable=False)
     num_fetched = Column(Integer, nullable=False)
     num_updated = Column(Integer, nullable=False)
@@ -56,3 +208,179 @@ class UpdateStat(Base):
     dur_std_feed = Column(Float, nullable=False)
     dur_max_feed = Column(Float, nullable=False)
     dur_max_feed_id = Column(Float, ForeignKey("feed.id"), nullable=True)
+    # bytes downloaded in the run, as sent and after decoding, and how many fewer
+    # were sent than the full, uncompressed documents (thanks to compression,
+    # 304 Not Modified and RFC 3229 deltas)
+    bytes_received = Column(Integer, nullable=True)
+    bytes_decoded = Column(Integer, nullable=True)
+    bytes_saved = Column(Integer, nullable=True)
+
+
+class BackupStat(Base):
+    """A snapshot of the database taken by backup.py."""
+
+    __tablename__ = "backup_stats"
+    timestamp = Column(DateTime, nullable=False, primary_key=True)
+    path = Column(String(512), nullable=False)
+    num_pages = Column(Integer, nullable=False)
+    # bytes in the database, and in the snapshot file after compression
+    size = Column(Integer, nullable=False)
+    stored_size = Column(Integer, nullable=False)
+    checksum = Column(String(64), nullable=False)
+    dur = Column(Float, nullable=False)
+
+
+# columns added after a table was first created, as (table, column, type)
+MIGRATED_COLUMNS = [
+    ("item", "dismissed", "DATETIME"),
+    ("item", "canonical_id", "INTEGER REFERENCES item(id)"),
+    ("feed", "content_hash", "VARCHAR(64)"),
+    ("feed", "last_fetched", "DATETIME"),
+    ("update_stats", "instance", "VARCHAR(128)"),
+    ("feed", "document_size", "INTEGER"),
+    ("feed", "bytes_received", "INTEGER"),
+    ("feed", "bytes_decoded", "INTEGER"),
+    ("update_stats", "bytes_received", "INTEGER"),
+    ("update_stats", "bytes_decoded", "INTEGER"),
+    ("update_stats", "bytes_saved", "INTEGER"),
+]
+
+# indexes from earlier versions of the schema that have been replaced
+OBSOLETE_INDEXES = [
+    "ix_item_published",
+    "ix_item_visited",
+    "ix_item_liked",
+    "ix_item_dismissed",
+    "ix_item_feed_id",
+    "ix_item_canonical_id",
+]
+
+# columns from earlier versions of the schema that are no longer recorded, as (table, column)
+OBSOLETE_COLUMNS = [
+    ("backup_stats", "num_restarts"),
+]
+
+# seconds a migration waits for the exclusive lock, e.g. while another process migrates
+MIGRATE_LOCK_TIMEOUT = 300
+
+
+def column_names(conn, table: str) -> set[str]:
+    return {
+        row["name"]
+        for row in conn.execute(text(f"PRAGMA table_info('{table}')")).mappings()
+    }
+
+
+def schema_is_current(conn) -> bool:
+    """Whether the database has every table, column and index, and no obsolete ones."""
+    schema_names = set(conn.execute(text("SELECT name FROM sqlite_master")).scalars())
+    if "sqlite_stat1" not in schema_names or schema_names & set(OBSOLETE_INDEXES):
+        return False
+    for table in Base.metadata.sorted_tables:
+        if table.name not in schema_names:
+            return False
+        if any(index.name not in schema_names for index in table.indexes):
+            return False
+    for table, column, _ in MIGRATED_COLUMNS:
+        if column not in column_names(conn, table):
+            return False
+    for table, column in OBSOLETE_COLUMNS:
+        if column in column_names(conn, table):
+            return False
+    return all(
+        primary_key_is_current(conn, table) for table in Base.metadata.tables.values()
+    )
+
+
+def primary_key_is_current(conn, table) -> bool:
+    existing = conn.execute(text(f"PRAGMA table_info('{table.name}')")).mappings()
+    key = sorted((row["pk"], row["name"]) for row in existing if row["pk"])
+    return [name for _, name in key] == [column.name for column in table.primary_key]
+
+
+def rebuild_table(conn, table):
+    """
+    Recreate a table from its model and copy its rows over, for changes such as
+    a new primary key that SQLite cannot make with ALTER TABLE.
+    """
+    old_name = f"{table.name}_old"
+    conn.execute(text(f"ALTER TABLE {table.name} RENAME TO {old_name}"))
+    conn.execute(CreateTable(table))
+    existing = conn.execute(text(f"PRAGMA table_info('{old_name}')")).mappings()
+    existing = {row["name"] for row in existing}
+    columns = [column for column in table.columns if column.name in existing]
+    # rows from before a column was part of the key get its default instead of NULL
+    values = [
+        (
+            f"COALESCE({column.name}, :{column.name})"
+            if column.primary_key and column.default is not None
+            else column.name
+        )
+        for column in columns
+    ]
+    conn.execute(
+        text(
+            f"INSERT INTO {table.name} ({', '.join(column.name for column in columns)}) "
+            f"SELECT {', '.join(values)} FROM {old_name}"
+        ),
+        {
+            column.name: column.default.arg
+            for column in columns
+            if column.primary_key and column.default is not None
+        },
+    )
+    conn.execute(text(f"DROP TABLE {old_name}"))
+
+
+def migrate(engine):
+    """
+    Create missing tables, columns and indexes in an existing database.
+
+    Every process that opens the database calls this, possibly at the same
+    time, so the changes are made in an exclusive transaction that checks the
+    schema again once it has the lock: only the first process changes anything.
+    """
+    with engine.connect() as conn:
+        # readers and writers don't block each other in WAL mode, which online
+        # backups rely on; the mode is kept in the database file
+        if conn.exec_driver_sql("PRAGMA journal_mode").scalar() not in (
+            "wal",
+            "memory",
+        ):
+            conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+        if schema_is_current(conn):
+            return
+    with engine.connect() as conn:
+        busy_timeout = conn.exec_driver_sql("PRAGMA busy_timeout").scalar()
+        conn.exec_driver_sql(f"PRAGMA busy_timeout = {MIGRATE_LOCK_TIMEOUT * 1000}")
+        try:
+            conn.exec_driver_sql("BEGIN EXCLUSIVE")
+            if not schema_is_current(conn):
+                migrate_schema(conn)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.exec_driver_sql(f"PRAGMA busy_timeout = {busy_timeout}")
+
+
+def migrate_schema(conn):
+    Base.metadata.create_all(conn)
+    for table, column, column_type in MIGRATED_COLUMNS:
+        if column not in column_names(conn, table):
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"))
+    for table, column in OBSOLETE_COLUMNS:
+        if column in column_names(conn, table):
+            conn.execute(text(f"ALTER TABLE {table} DROP COLUMN {column}"))
+    for table in Base.metadata.sorted_tables:
+        if not primary_key_is_current(conn, table):
+            rebuild_table(conn, table)
+    for index in OBSOLETE_INDEXES:
+        conn.execute(text(f"DROP INDEX IF EXISTS {index}"))
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            conn.execute(CreateIndex(index, if_not_exists=True))
+    # The planner needs statistics to prefer the partial indexes on Item over
+    # the general ones, so gather them whenever the indexes change.
+    conn.execute(text("ANALYZE"))
@@ -0,0 +1,46 @@
+import io
+import time
+from datetime import datetime
+
+import feedparser
+
+# An entry reduced to plain values so it is cheap to send between processes:
+# (title, link, published, description, author)
+ParsedEntry = tuple[str, str, datetime, str | None, str | None]
+
+
+def datetime_from_time(t):
+    return datetime.fromtimestamp(time.mktime(t))
+
+
+def parse_feed(
+    body: bytes, headers: dict[str, str], last_published_date: datetime
+) -> tuple[str | None, list[ParsedEntry]]:
+    """
+    Parse a downloaded feed document, returning the feed's title and the entries
+    published after `last_published_date`.
+
+    This is pure CPU work with no database access, so it can run in a separate
+    process to avoid contending for the GIL with the threads doing network I/O.
+    """
+    data = feedparser.parse(io.BytesIO(body), response_headers=headers)
+    feed_pub_date = data.feed.get(
+        "published_parsed", data.feed.get("updated_parsed", time.localtime())
+    )
+    entries = []
+    for entry in data.entries:
+        published = datetime_from_time(
+            entry.get("published_parsed", entry.get("updated_parsed", feed_pub_date))
+        )
+        if published <= last_published_date:
+            continue
+        entries.append(
+            (
+                entry.get("title", entry.get("link", "Untitled Item")),
+                entry.get("link", 'javascript:alert("no link provided for item")'),
+                published,
+                entry.get("description", None),
+                entry.get("author", None),
+            )
+        )
+    return data.feed.get("title", None), entries
@@ -1,11 +1,15 @@
-from urllib.parse import urlencode, urlunparse
+import os
+import time
+import atexit
+import threading
 from flask import (
     Flask,
-    Request,
+    Response,
     abort,
     render_template,
     request,
     redirect,
+    send_file,
     url_for,
     jsonify,
 )
@@ -17,10 +21,13 @@ from logic import (
     add_feed,
     delete_feed,
     fetch_update_stats,
+    last_backup_stats,
     item_list,
     overview,
     feed_list,
     record_visit,
+    flush_visits,
+    VISIT_FLUSH_INTERVAL,
     toggle_feed_downrank,
     update_feed_title,
     toggle_like,
@@ -28,39 +35,62 @@ from logic import (
     unvisited_items_after,
 )
 from stats_plot import plot_update_stats_figure
-from models import Base
-from models import Item
-from sqlalchemy import text
-
-app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///rss_feeds.db"
+from backup import BACKUP_DIR, create_snapshot, list_snapshots
+from assets import compress_response, load_static_assets, static_asset_response
+from image_proxy import IMAGE_MAX_AGE, ImageCache, is_image_key
+from templating import format_date, update_query
+from update import (
+    claim_feed,
+    default_instance_name,
+    ingest_feed,
+    ingest_pushes,
+    release_lease,
+)
+from websub import signature_matches, verify_intent
+from models import Feed, Item, ProxiedImage, WebSubPush, migrate
+
+# static files are served by `send_static` below rather than Flask's default route
+app = Flask(__name__, static_folder=None)
+# can be pointed at another database, e.g. one made by benchmarks/synthetic_db.py
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
+    "RSRSSR_DATABASE_URI", "sqlite:///rss_feeds.db"
+)
 db = SQLAlchemy(app)
 
 with app.app_context():
-    Base.metadata.create_all(bind=db.engine)
-    # Migrate: add dismissed column if it doesn't exist
-    with db.engine.connect() as conn:
-        existing = conn.execute(text("PRAGMA table_info('item')")).mappings().all()
-        if not any(row["name"] == "dismissed" for row in existing):
-            conn.execute(text("ALTER TABLE item ADD COLUMN dismissed DATETIME"))
+    migrate(db.engine)
+
+static_assets = load_static_assets(os.path.join(app.root_path, "static"))
+app.after_request(compress_response)
+image_cache = ImageCache()
+
+
+def flush_visits_in_app_context():
+    with app.app_context():
+        flush_visits(db.session)
+
 
+def flush_visits_periodically():
+    while True:
+        time.sleep(VISIT_FLUSH_INTERVAL)
+        try:
+            flush_visits_in_app_context()
+        except Exception as e:
+            print(f"failed to write visits: {e}")
 
-@app.template_filter("format_date")
-def format_date(value, format="%d %B %Y, %I:%M %p"):
-    if value is None:
-        return None
-    return value.strftime(format)
 
+threading.Thread(target=flush_visits_periodically, daemon=True).start()
+atexit.register(flush_visits_in_app_context)
 
-@app.template_filter("update_query")
-def update_query(request: Request, key: str, value):
-    new_args = request.args.copy()
-    if value is None:
-        new_args.pop(key)
-    else:
-        new_args[key] = value
-    new_query = urlencode(new_args, doseq=True)
-    return f"{request.path}?{new_query}"
+
+@app.template_global("static_url")
+def static_url(name: str) -> str:
+    """URL of a static file that changes whenever its contents do."""
+    return f"/static/{static_assets[name].fingerprinted_name}"
+
+
+app.add_template_filter(format_date)
+app.add_template_filter(update_query)
 
 
 @app.route("/")
@@ -164,13 +194,136 @@ def graph_update_stats():
     timeframe = request.args.get("window", default="week", type=str)
     data = fetch_update_stats(db.session, timeframe)
     fig = plot_update_stats_figure(data)
-    fig_html = plotly.io.to_html(fig, full_html=False, default_height="80vh")
-    return render_template("stats.html", figure=fig_html)
+    fig_html = plotly.io.to_html(fig, full_html=False, default_height="120vh")
+    return render_template(
+        "stats.html", figure=fig_html, last_backup=last_backup_stats(db.session)
+    )
+
+
+@app.route("/websub/<int:feed_id>", methods=["GET", "POST"])
+def websub_callback(feed_id):
+    """
+    The callback of a feed's WebSub subscription: hubs verify the subscription
+    with a GET and push the feed's new content with a POST.
+    """
+    feed = db.session.get(Feed, feed_id)
+    subscription = feed and feed.websub
+    if subscription is None:
+        abort(404)
+    if request.method == "GET":
+        challenge = verify_intent(subscription, request.args)
+        db.session.commit()
+        if challenge is None:
+            abort(404)
+        return Response(challenge, mimetype="text/plain")
+
+    body = request.get_data()
+    # WebSub asks for content with a bad signature to be acknowledged, but ignored
+    if signature_matches(
+        subscription.secret, body, request.headers.get("X-Hub-Signature")
+    ):
+        # pushed content is added under the feed's lease, like polled content
+        owner = f"websub:{default_instance_name()}"
+        if not claim_feed(db.session, feed.id, owner):
+            # the updater holding the lease adds it before giving the lease up
+            db.session.add(
+                WebSubPush(
+                    feed_id=feed.id,
+                    received=datetime.datetime.now(),
+                    content_type=request.content_type,
+                    body=body,
+                )
+            )
+            db.session.commit()
+            print(f"queued content pushed for {feed.url} (#{feed.id}) while leased")
+            return Response(status=204)
+        headers = {
+            "content-type": request.content_type or "",
+            "content-location": subscription.topic,
+        }
+        try:
+            items = ingest_pushes(db.session, feed)
+            items += ingest_feed(db.session, feed, body, headers)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            release_lease(db.session, feed.id, owner, fetched=False)
+            db.session.commit()
+        print(f"received {len(items)} new items pushed for {feed.url} (#{feed.id})")
+    return Response(status=204)
+
+
+# the snapshot POST /backup is taking in the background, if any
+backup_thread = None
+backup_thread_lock = threading.Lock()
+
+
+def take_snapshot():
+    with app.app_context():
+        try:
+            stat = create_snapshot(db.engine.url.database, BACKUP_DIR)
+            db.session.add(stat)
+            db.session.commit()
+            print(f"backed up to {stat.path} in {stat.dur:.2f}s")
+        except Exception as e:
+            print(f"failed to back up the database: {e}")
+
+
+@app.route("/backup", methods=["GET", "POST"])
+def page_backup():
+    """
+    POST starts taking a snapshot of the database in the background, unless one
+    is being taken already; GET downloads the newest snapshot.
+    """
+    global backup_thread
+    if request.method == "POST":
+        with backup_thread_lock:
+            running = backup_thread is not None and backup_thread.is_alive()
+            if not running:
+                backup_thread = threading.Thread(target=take_snapshot)
+                backup_thread.start()
+        response = jsonify({"status": "running" if running else "started"})
+        response.status_code = 202
+        response.headers["Location"] = url_for("page_backup")
+        return response
+    snapshots = list_snapshots(BACKUP_DIR)
+    if not snapshots:
+        abort(404)
+    return send_file(os.path.abspath(snapshots[-1]), as_attachment=True)
 
 
 @app.route("/static/<path:path>")
 def send_static(path):
-    return app.send_static_file(path)
+    asset = static_assets.get(path)
+    if asset is None:
+        abort(404)
+    return static_asset_response(asset, path)
+
+
+@app.route("/img/<key>")
+def send_proxied_image(key: str):
+    # only images that items refer to are served, and the key names a file
+    if not is_image_key(key):
+        abort(404)
+    proxied = db.session.get(ProxiedImage, key)
+    if proxied is None:
+        abort(404)
+    image = image_cache.get(key)
+    if image is None:
+        try:
+            image = image_cache.fetch(key, proxied.url)
+        except (OSError, ValueError) as e:
+            print(f"failed to proxy image {proxied.url}: {e}")
+        if image is None:
+            # let the browser try the original itself
+            return redirect(proxied.url)
+    data, mimetype = image
+    response = Response(data, mimetype=mimetype)
+    response.headers["Cache-Control"] = f"public, max-age={IMAGE_MAX_AGE}, immutable"
+    response.headers["X-Content-Type-Options"] = "nosniff"
+    return response
 
 
 @app.route("/go/<int:item_id>")
@@ -7,19 +7,21 @@ from sqlalchemy.orm import scoped_session
 
 
 def plot_update_stats_figure(data: pd.DataFrame) -> go.Figure:
-    # Create subplots: 2 rows, 2 columns
+    # Create subplots: 3 rows, 2 columns, the last spanning both
     fig = make_subplots(
-        rows=2,
+        rows=3,
         cols=2,
         subplot_titles=(
             "Total Update Time and Feed Count",
             "New Items over Time",
             "Fetched, Updated, and Failed",
             "Per-Feed Update Time",
+            "Bandwidth",
         ),
         specs=[
             [{"secondary_y": True}, {"secondary_y": False}],
             [{"secondary_y": False}, {"secondary_y": False}],
+            [{"colspan": 2}, None],
         ],
         shared_xaxes=False,
         vertical_spacing=0.1,
@@ -33,6 +35,8 @@ def plot_update_stats_figure(data: pd.DataFrame) -> go.Figure:
             y=data["dur_total"],
             mode="lines",
             name="Total Duration",
+            text=data["num_instances"],
+            hovertemplate="%{y}s; %{text} updater instance(s)",
         ),
         row=1,
         col=1,
@@ -128,6 +132,33 @@ def plot_update_stats_figure(data: pd.DataFrame) -> go.Figure:
     )
     fig.update_yaxes(title_text="Duration (ms)", row=2, col=2)
 
+    # Plot 5: bytes received and saved by compression, 304s and delta feeds
+    fig.add_trace(
+        go.Scatter(
+            x=data["timestamp"],
+            y=data["bytes_received"] / 2**20,
+            mode="lines",
+            name="Received",
+            hovertemplate="%{y:.2f} MiB",
+        ),
+        row=3,
+        col=1,
+    )
+    fig.add_trace(
+        go.Scatter(
+            x=data["timestamp"],
+            y=data["bytes_saved"] / 2**20,
+            mode="lines",
+            name="Saved",
+            text=data["bytes_saved"]
+            / (data["bytes_saved"] + data["bytes_received"]).where(lambda t: t > 0),
+            hovertemplate="%{y:.2f} MiB (%{text:.0%})",
+        ),
+        row=3,
+        col=1,
+    )
+    fig.update_yaxes(title_text="MiB", row=3, col=1)
+
     # Update layout for a clean look
     fig.update_layout(
         title_text="RSS Updates",
@@ -0,0 +1,21 @@
+from urllib.parse import urlencode
+
+from werkzeug.wrappers import Request
+
+# Template filters shared by the Flask app (server.py) and the ASGI app (asgi.py).
+
+
+def format_date(value, format="%d %B %Y, %I:%M %p"):
+    if value is None:
+        return None
+    return value.strftime(format)
+
+
+def update_query(request: Request, key: str, value):
+    new_args = request.args.copy()
+    if value is None:
+        new_args.pop(key)
+    else:
+        new_args[key] = value
+    new_query = urlencode(new_args, doseq=True)
+    return f"{request.path}?{new_query}"
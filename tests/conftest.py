@@ -0,0 +1,14 @@
+"""
+server.py and asgi.py bind to their database when they are first imported, so
+the database every test module shares is chosen here, before any of them is
+imported, rather than by whichever test module happens to import them first.
+"""
+
+import os
+import tempfile
+
+database_dir = tempfile.TemporaryDirectory()
+# never the database named in the environment, which may be a real one
+os.environ["RSRSSR_DATABASE_URI"] = (
+    f"sqlite:///{os.path.join(database_dir.name, 'rss_feeds.db')}"
+)
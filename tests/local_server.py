@@ -0,0 +1,78 @@
+import threading
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class LocalServer:
+    """
+    A stand-in for remote servers: serves canned responses from `routes`,
+    a dict of path -> (status, headers, body) or a callable taking the handler
+    and returning that tuple. Every request is recorded in `requests`.
+    """
+
+    def __init__(self, routes=None):
+        self.routes = routes if routes is not None else {}
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _respond(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                self.body = self.rfile.read(length) if length else b""
+                server.requests.append(
+                    (self.command, self.path, dict(self.headers), self.body)
+                )
+                route = server.routes.get(self.path.split("?")[0])
+                if route is None:
+                    status, headers, body = 404, {}, b""
+                elif callable(route):
+                    status, headers, body = route(self)
+                else:
+                    status, headers, body = route
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = _respond
+            do_POST = _respond
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, args=(0.05,), daemon=True
+        )
+
+    def url(self, path):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}{path}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def rss(*entries, title="Test Feed"):
+    """Build an RSS document from (title, link, pubDate) tuples."""
+    items = "".join(
+        f"<item><title>{t}</title><link>{l}</link><pubDate>{d}</pubDate></item>"
+        for t, l, d in entries
+    )
+    return (
+        f'<?xml version="1.0"?><rss version="2.0"><channel><title>{title}</title>'
+        f"{items}</channel></rss>"
+    ).encode("utf-8")
+
+
+def hours_ago(hours):
+    """An RSS pubDate `hours` before now."""
+    return format_datetime(datetime.now(timezone.utc) - timedelta(hours=hours))
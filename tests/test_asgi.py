@@ -0,0 +1,231 @@
+"""
+Parity tests between the routes served by the ASGI app (asgi.py) and the same
+routes in the Flask app (server.py), both running against one database.
+"""
+
+import asyncio
+import fcntl
+import gzip
+import re
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta
+
+from sqlalchemy.orm import sessionmaker
+
+from models import Feed, Item
+
+# both bound to the database chosen in conftest.py
+import asgi
+import logic
+import server
+
+LOAD_TIME_RE = re.compile(rb"Loaded now in [0-9.e-]+s\.")
+
+
+def seed():
+    """
+    Add three feeds with 120 items between them, titled after their ids.
+    Returns the ids of the feeds and of the items, newest first.
+    """
+    with server.app.app_context():
+        session = sessionmaker(bind=server.db.engine)()
+    now = datetime.now()
+    feeds = [
+        Feed(url=f"https://example.com/{i}/feed", title=f"Feed {i}") for i in range(3)
+    ]
+    session.add_all(feeds)
+    items = []
+    for i in range(120):
+        published = now - timedelta(hours=i)
+        items.append(
+            Item(
+                title="",
+                link="",
+                published=published,
+                description=f"<p>Description {i}</p>",
+                author=f"author {i % 4}" if i % 3 else None,
+                feed=feeds[i % 3],
+                visited=published if i % 4 == 0 else None,
+                liked=published if i % 10 == 0 else None,
+                dismissed=published if i % 7 == 0 else None,
+            )
+        )
+    session.add_all(items)
+    session.flush()
+    for item in items:
+        item.title = f"Item {item.id} <b>&</b>"
+        item.link = f"https://example.com/items/{item.id}"
+    session.commit()
+    ids = [feed.id for feed in feeds], [item.id for item in items]
+    session.close()
+    return ids
+
+
+async def asgi_request(method, url, headers=()):
+    path, _, query = url.partition("?")
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": query.encode(),
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers],
+        "http_version": "1.1",
+        "scheme": "http",
+        "server": ("localhost", 80),
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi.app(scope, receive, send)
+    start, body = messages
+    headers = {k.decode().lower(): v.decode() for k, v in start["headers"]}
+    return start["status"], headers, body["body"]
+
+
+class AsgiParityTests(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.feed_ids, cls.item_ids = seed()
+        cls.client = server.app.test_client()
+
+    async def asyncTearDown(self):
+        # the pooled connections belong to this test's event loop
+        await asgi.engine.dispose()
+
+    def flask_request(self, method, url, headers=()):
+        response = self.client.open(url, method=method, headers=list(headers))
+        headers = {k.lower(): v for k, v in response.headers.items()}
+        return response.status_code, headers, response.get_data()
+
+    async def assertSameResponse(self, method, url, headers=()):
+        flask_status, flask_headers, flask_body = self.flask_request(
+            method, url, headers
+        )
+        status, headers, body = await asgi_request(method, url, headers)
+        self.assertEqual(status, flask_status, url)
+        for header in (
+            "content-type",
+            "content-encoding",
+            "location",
+            "cache-control",
+            "etag",
+            "vary",
+        ):
+            self.assertEqual(headers.get(header), flask_headers.get(header), header)
+        if headers.get("content-encoding") == "gzip":
+            # the gzip header holds the time of compression
+            body, flask_body = gzip.decompress(body), gzip.decompress(flask_body)
+        self.assertEqual(
+            LOAD_TIME_RE.sub(b"", body), LOAD_TIME_RE.sub(b"", flask_body), url
+        )
+        return status, body
+
+    async def test_pages(self):
+        feed = self.feed_ids[1]
+        for url in (
+            "/",
+            "/list",
+            "/list?k=visited",
+            "/list?k=liked",
+            "/list?offset=48",
+            f"/list?feed={feed}",
+            f"/list?feed={feed}&k=visited&offset=0",
+            "/list?offset=bogus",
+            "/list?k=bogus",
+            "/missing",
+        ):
+            await self.assertSameResponse("GET", url)
+        status, body = await self.assertSameResponse("GET", f"/list?feed={feed}")
+        self.assertEqual(status, 200)
+        title = f"Item {self.item_ids[1]} &lt;b&gt;&amp;&lt;/b&gt;"
+        self.assertIn(title.encode(), body)
+
+    async def test_compressed_pages(self):
+        for url in ("/", "/list?k=visited"):
+            await self.assertSameResponse("GET", url, [("Accept-Encoding", "gzip")])
+
+    async def test_api_unvisited(self):
+        after = (datetime.now() - timedelta(days=2)).isoformat()
+        status, body = await self.assertSameResponse(
+            "GET", f"/api/unvisited?after={after}"
+        )
+        self.assertEqual(status, 200)
+        self.assertIn(b'"feedName":"Feed 1"', body)
+        for url in ("/api/unvisited", "/api/unvisited?after=yesterday"):
+            await self.assertSameResponse("GET", url)
+
+    async def test_static_files(self):
+        name = asgi.static_assets["styles.css"].fingerprinted_name
+        for url in ("/static/styles.css", f"/static/{name}", "/static/missing.css"):
+            await self.assertSameResponse("GET", url, [("Accept-Encoding", "gzip")])
+
+    async def test_bad_requests(self):
+        for method, url in (
+            ("POST", "/visit"),
+            ("POST", "/like?id=zero"),
+            ("POST", "/dismiss"),
+            ("GET", "/visit?id=1"),
+        ):
+            await self.assertSameResponse(method, url)
+
+    async def test_visit_like_and_dismiss(self):
+        visited, liked, dismissed = self.item_ids[5], self.item_ids[6], self.item_ids[9]
+        status, _, body = await asgi_request("POST", f"/visit?id={visited}")
+        self.assertEqual((status, body), (200, b""))
+        _, _, flask_body = self.flask_request("GET", "/list?k=visited")
+        self.assertIn(f"Item {visited} ".encode(), flask_body)
+
+        referrer = [("Referer", "/list?k=liked")]
+        status, headers, _ = await asgi_request("POST", f"/like?id={liked}", referrer)
+        self.assertEqual((status, headers["location"]), (302, "/list?k=liked"))
+        _, _, flask_body = self.flask_request("GET", "/list?k=liked")
+        self.assertIn(f"Item {liked} ".encode(), flask_body)
+        status, headers, _ = self.flask_request("POST", f"/like?id={liked}", referrer)
+        self.assertEqual((status, headers["location"]), (302, "/list?k=liked"))
+        _, _, body = await asgi_request("GET", "/list?k=liked")
+        self.assertNotIn(f"Item {liked} ".encode(), body)
+
+        after = (datetime.now() - timedelta(days=2)).isoformat()
+        link = f'/items/{dismissed}"'.encode()
+        _, _, body = await asgi_request("GET", f"/api/unvisited?after={after}")
+        self.assertIn(link, body)
+        status, headers, _ = await asgi_request("POST", f"/dismiss?id={dismissed}")
+        self.assertEqual((status, headers["location"]), (302, "/"))
+        _, _, flask_body = self.flask_request("GET", f"/api/unvisited?after={after}")
+        self.assertNotIn(link, flask_body)
+
+    async def test_concurrent_requests(self):
+        after = (datetime.now() - timedelta(days=2)).isoformat()
+        # the visited items are older than the listed ones, so every read lists the same
+        responses = await asyncio.gather(
+            *(asgi_request("GET", f"/api/unvisited?after={after}") for _ in range(50)),
+            *(asgi_request("POST", f"/visit?id={id}") for id in self.item_ids[60:110]),
+        )
+        self.assertEqual({status for status, _, _ in responses}, {200})
+        bodies = {body for _, _, body in responses[:50]}
+        self.assertEqual(len(bodies), 1)
+
+    async def test_visits_do_not_block_the_event_loop(self):
+        with open(logic.visit_log(asgi.engine).path, "ab") as log:
+            # as a flush holds the log while it cuts it
+            fcntl.flock(log, fcntl.LOCK_EX)
+            threading.Timer(0.5, fcntl.flock, (log, fcntl.LOCK_UN)).start()
+            visit = asyncio.create_task(
+                asgi_request("POST", f"/visit?id={self.item_ids[110]}")
+            )
+            start = time.monotonic()
+            await asyncio.sleep(0.05)
+            self.assertLess(time.monotonic() - start, 0.3)
+            status, _, _ = await visit
+        self.assertEqual(status, 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import gzip
+import os
+import tempfile
+import unittest
+
+from flask import Flask
+
+from assets import (
+    COMPRESS_MIN_SIZE,
+    compress_response,
+    load_static_assets,
+    static_asset_response,
+)
+
+
+class AssetTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.tmpdir.name, "styles.css"), "w") as f:
+            f.write("body { color: black; }\n" * 100)
+        self.assets = load_static_assets(self.tmpdir.name)
+
+        app = Flask(__name__, static_folder=None)
+        app.after_request(compress_response)
+
+        @app.route("/static/<path:path>")
+        def send_static(path):
+            return static_asset_response(self.assets[path], path)
+
+        @app.route("/page")
+        def page():
+            return "<p>hello</p>" * COMPRESS_MIN_SIZE
+
+        @app.route("/small")
+        def small():
+            return "<p>hello</p>"
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_fingerprinted_name_changes_with_content(self):
+        asset = self.assets["styles.css"]
+        self.assertIs(self.assets[asset.fingerprinted_name], asset)
+        with open(os.path.join(self.tmpdir.name, "styles.css"), "w") as f:
+            f.write("body { color: white; }\n")
+        changed = load_static_assets(self.tmpdir.name)["styles.css"]
+        self.assertNotEqual(changed.fingerprinted_name, asset.fingerprinted_name)
+
+    def test_fingerprinted_asset_is_immutable_and_precompressed(self):
+        asset = self.assets["styles.css"]
+        response = self.client.get(
+            f"/static/{asset.fingerprinted_name}",
+            headers={"Accept-Encoding": "gzip"},
+        )
+        self.assertIn("immutable", response.headers["Cache-Control"])
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(response.data), asset.variants["identity"])
+
+    def test_plain_name_is_revalidated(self):
+        response = self.client.get("/static/styles.css")
+        self.assertEqual(response.headers["Cache-Control"], "no-cache")
+        self.assertNotIn("Content-Encoding", response.headers)
+        revalidated = self.client.get(
+            "/static/styles.css",
+            headers={"If-None-Match": response.headers["ETag"]},
+        )
+        self.assertEqual(revalidated.status_code, 304)
+
+    def test_large_html_is_compressed(self):
+        response = self.client.get("/page", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response.headers["Vary"])
+        self.assertEqual(
+            gzip.decompress(response.data).decode(), "<p>hello</p>" * COMPRESS_MIN_SIZE
+        )
+
+    def test_small_or_unaccepted_responses_are_not_compressed(self):
+        small = self.client.get("/small", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", small.headers)
+        plain = self.client.get("/page")
+        self.assertNotIn("Content-Encoding", plain.headers)
+
+
+if __name__ == "__main__":
+    unittest.main()
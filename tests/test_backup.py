@@ -0,0 +1,204 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import backup
+from models import Base, BackupStat
+
+# bound to the database chosen in conftest.py
+import server
+
+
+class TestBackup(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmpdir.name, "rss_feeds.db")
+        self.backup_dir = os.path.join(self.tmpdir.name, "backups")
+        with sqlite3.connect(self.db_path) as conn:
+            # as models.migrate leaves every database
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, body TEXT)")
+            conn.executemany("INSERT INTO t (body) VALUES (?)", [("x" * 1000,)] * 2000)
+        conn.close()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def count_rows(self, path):
+        with sqlite3.connect(path) as conn:
+            count = conn.execute("SELECT COUNT(*) FROM t").fetchone()[0]
+        conn.close()
+        return count
+
+    def test_snapshot_is_checksummed_and_restorable(self):
+        stat = backup.create_snapshot(self.db_path, self.backup_dir)
+
+        self.assertTrue(stat.path.endswith(".db.gz"))
+        self.assertTrue(backup.verify_snapshot(stat.path))
+        self.assertLess(stat.stored_size, stat.size)
+        with open(stat.path + backup.CHECKSUM_SUFFIX) as f:
+            self.assertEqual(
+                f.read(), f"{stat.checksum}  {os.path.basename(stat.path)}\n"
+            )
+
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("DELETE FROM t WHERE id > 10")
+        conn.close()
+        backup.restore_snapshot(stat.path, self.db_path)
+        self.assertEqual(self.count_rows(self.db_path), 2000)
+        with sqlite3.connect(self.db_path) as conn:
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        conn.close()
+
+    def test_corrupted_snapshot_is_not_restored(self):
+        stat = backup.create_snapshot(self.db_path, self.backup_dir, compress=False)
+        with open(stat.path, "r+b") as f:
+            f.seek(5000)
+            f.write(b"garbage")
+        self.assertFalse(backup.verify_snapshot(stat.path))
+
+        with self.assertRaises(ValueError):
+            backup.restore_snapshot(stat.path, self.db_path)
+        self.assertEqual(self.count_rows(self.db_path), 2000)
+
+    def test_old_snapshots_are_rotated(self):
+        for i in range(4):
+            path = os.path.join(
+                self.backup_dir, f"{backup.SNAPSHOT_PREFIX}2020010{i}T000000.db"
+            )
+            os.makedirs(self.backup_dir, exist_ok=True)
+            for name in (path, path + backup.CHECKSUM_SUFFIX):
+                open(name, "w").close()
+
+        stat = backup.create_snapshot(self.db_path, self.backup_dir, keep=2)
+
+        snapshots = backup.list_snapshots(self.backup_dir)
+        self.assertEqual(len(snapshots), 2)
+        self.assertEqual(snapshots[-1], stat.path)
+        self.assertEqual(
+            sorted(os.listdir(self.backup_dir)),
+            sorted(
+                os.path.basename(p) + suffix
+                for p in snapshots
+                for suffix in ("", backup.CHECKSUM_SUFFIX)
+            ),
+        )
+
+    def test_writers_are_not_blocked_during_backup(self):
+        with sqlite3.connect(self.db_path) as conn:
+            conn.executemany("INSERT INTO t (body) VALUES (?)", [("x" * 1000,)] * 18000)
+        conn.close()
+        backing_up, done = threading.Event(), threading.Event()
+        written, errors = [], []
+
+        def write():
+            # no busy timeout: fails with "database is locked" at once if the backup blocks it
+            with sqlite3.connect(self.db_path, timeout=0) as conn:
+                while not done.is_set():
+                    try:
+                        conn.execute("INSERT INTO t (body) VALUES ('new')")
+                        conn.commit()
+                        written.append(backing_up.is_set())
+                    except sqlite3.OperationalError as e:
+                        errors.append(e)
+                        conn.rollback()
+            conn.close()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        copies = []
+        try:
+            for i in range(3):
+                dest = os.path.join(self.tmpdir.name, f"copy{i}.db")
+                backing_up.set()
+                num_pages = backup.backup_database(self.db_path, dest)
+                backing_up.clear()
+                copies.append(dest)
+        finally:
+            done.set()
+            writer.join()
+
+        self.assertEqual(errors, [])
+        self.assertIn(True, written)
+        self.assertGreater(num_pages, 0)
+        for dest in copies:
+            # each copy is consistent, from some point during the writes
+            self.assertGreaterEqual(self.count_rows(dest), 20000)
+            with sqlite3.connect(dest) as conn:
+                self.assertEqual(
+                    conn.execute("PRAGMA integrity_check").fetchone()[0], "ok"
+                )
+                self.assertEqual(
+                    conn.execute("PRAGMA journal_mode").fetchone()[0], "delete"
+                )
+            conn.close()
+
+    def test_databases_not_in_wal_mode_are_refused(self):
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("PRAGMA journal_mode=DELETE")
+        conn.close()
+        with self.assertRaises(ValueError):
+            backup.backup_database(
+                self.db_path, os.path.join(self.tmpdir.name, "copy.db")
+            )
+
+    def test_backup_route_snapshots_in_the_background(self):
+        client = server.app.test_client()
+        with mock.patch.object(server, "BACKUP_DIR", self.backup_dir):
+            self.assertEqual(client.get("/backup").status_code, 404)
+            response = client.post("/backup")
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response.headers["Location"], "/backup")
+            server.backup_thread.join()
+            response = client.get("/backup")
+            self.assertEqual(response.status_code, 200)
+            (snapshot,) = backup.list_snapshots(self.backup_dir)
+            with open(snapshot, "rb") as f:
+                self.assertEqual(response.get_data(), f.read())
+            response.close()
+        with server.app.app_context():
+            session = sessionmaker(bind=server.db.engine)()
+        self.assertEqual(
+            session.query(BackupStat.path)
+            .order_by(BackupStat.timestamp.desc())
+            .first(),
+            (snapshot,),
+        )
+        session.close()
+
+    def test_backup_due(self):
+        engine = create_engine("sqlite:///:memory:")
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        self.assertTrue(backup.backup_due(session))
+
+        def record(age):
+            session.add(
+                BackupStat(
+                    timestamp=datetime.now() - age,
+                    path="snapshot",
+                    num_pages=1,
+                    size=1,
+                    stored_size=1,
+                    checksum="0" * 64,
+                    dur=0.1,
+                )
+            )
+            session.commit()
+
+        record(backup.BACKUP_INTERVAL + timedelta(minutes=1))
+        self.assertTrue(backup.backup_due(session))
+        record(timedelta(minutes=1))
+        self.assertFalse(backup.backup_due(session))
+        session.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
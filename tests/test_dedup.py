@@ -0,0 +1,193 @@
+import os
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models import Base, Feed, Item, ItemFingerprint
+
+from local_server import LocalServer, hours_ago, rss
+from logic import (
+    delete_feed,
+    flush_visits,
+    item_list,
+    overview,
+    record_dismiss,
+    record_visit,
+    toggle_like,
+)
+from update import normalize_link, update_feed
+
+
+class NormalizeLinkTests(unittest.TestCase):
+    def test_mirrors_of_the_same_article_normalize_equal(self):
+        self.assertEqual(
+            normalize_link(
+                "https://www.Example.com/post/1/?utm_source=rss&b=2&a=1#top"
+            ),
+            normalize_link("http://example.com/post/1?a=1&b=2"),
+        )
+
+    def test_different_articles_stay_distinct(self):
+        self.assertNotEqual(
+            normalize_link("https://example.com/post/1"),
+            normalize_link("https://example.com/post/2"),
+        )
+
+    def test_only_exact_tracking_names_are_dropped(self):
+        self.assertEqual(
+            normalize_link("https://example.com/post?id=1&ref=rss&fbclid=x"),
+            normalize_link("https://example.com/post?id=1"),
+        )
+        self.assertNotEqual(
+            normalize_link("https://example.com/post?refid=1"),
+            normalize_link("https://example.com/post?refid=2"),
+        )
+
+
+class CrossFeedDuplicateTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        engine = create_engine(f"sqlite:///{os.path.join(self.tmpdir.name, 'test.db')}")
+        Base.metadata.create_all(engine)
+        self.engine = engine
+        self.session = sessionmaker(bind=engine)()
+        self.server = LocalServer(
+            {
+                "/original": (
+                    200,
+                    {"Content-Type": "application/rss+xml"},
+                    rss(
+                        ("Shared", "https://example.com/shared", hours_ago(2)),
+                        ("Only here", "https://example.com/unique", hours_ago(3)),
+                    ),
+                ),
+                "/second-mirror": (
+                    200,
+                    {"Content-Type": "application/rss+xml"},
+                    rss(("Shared", "https://example.com/shared?ref=x", hours_ago(1))),
+                ),
+                "/mirror": (
+                    200,
+                    {"Content-Type": "application/rss+xml"},
+                    rss(
+                        (
+                            "Shared (mirrored)",
+                            "https://www.example.com/shared/?utm_medium=feed",
+                            hours_ago(1),
+                        ),
+                    ),
+                ),
+            }
+        ).__enter__()
+        self.original = Feed(url=self.server.url("/original"))
+        self.mirror = Feed(url=self.server.url("/mirror"))
+        self.session.add_all([self.original, self.mirror])
+        self.session.commit()
+        update_feed(self.session, self.original)
+        self.session.commit()
+        update_feed(self.session, self.mirror)
+        self.session.commit()
+
+    def tearDown(self):
+        self.server.__exit__()
+        self.session.close()
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def _items(self, feed):
+        return self.session.query(Item).filter_by(feed_id=feed.id).all()
+
+    def test_copy_is_linked_to_canonical_item(self):
+        (copy,) = self._items(self.mirror)
+        canonical = (
+            self.session.query(Item).filter_by(link="https://example.com/shared").one()
+        )
+        self.assertEqual(copy.canonical_id, canonical.id)
+        self.assertIsNone(canonical.canonical_id)
+        self.assertEqual(self.session.query(ItemFingerprint).count(), 2)
+
+    def test_copies_are_collapsed_in_listings(self):
+        listed = item_list(self.session, "all", 0, None)["items"]
+        self.assertEqual(sorted(i.title for i in listed), ["Only here", "Shared"])
+        feeds = overview(self.session)["feeds"]
+        self.assertEqual([f["id"] for f in feeds], [self.original.id])
+        # a feed's own page still shows its copies
+        listed = item_list(self.session, "all", 0, self.mirror.id)["items"]
+        self.assertEqual([i.title for i in listed], ["Shared (mirrored)"])
+
+    def test_visit_and_dismiss_propagate_to_all_copies(self):
+        (copy,) = self._items(self.mirror)
+        record_visit(self.session, copy.id)
+        flush_visits(self.session)
+        self.session.expire_all()
+        visited = self.session.query(Item).filter(Item.visited != None).all()
+        self.assertEqual(len(visited), 2)
+
+        record_dismiss(self.session, copy.canonical_id)
+        self.session.expire_all()
+        dismissed = self.session.query(Item).filter(Item.dismissed != None).all()
+        self.assertEqual(len(dismissed), 2)
+
+    def test_copies_ingested_later_share_the_state_of_the_first(self):
+        canonical = (
+            self.session.query(Item).filter_by(link="https://example.com/shared").one()
+        )
+        record_visit(self.session, canonical.id)
+        flush_visits(self.session)
+        record_dismiss(self.session, canonical.id)
+        toggle_like(self.session, canonical.id)
+        second_mirror = Feed(url=self.server.url("/second-mirror"))
+        self.session.add(second_mirror)
+        self.session.commit()
+        update_feed(self.session, second_mirror)
+        self.session.commit()
+        self.session.expire_all()
+        (copy,) = self._items(second_mirror)
+        canonical = self.session.get(Item, canonical.id)
+        self.assertEqual(
+            (copy.visited, copy.dismissed, copy.liked),
+            (canonical.visited, canonical.dismissed, canonical.liked),
+        )
+        self.assertIsNotNone(copy.visited)
+
+    def test_liking_a_copy_shows_in_the_liked_list_of_all_feeds(self):
+        (copy,) = self._items(self.mirror)
+        toggle_like(self.session, copy.id)
+        self.session.expire_all()
+        liked = item_list(self.session, "liked", 0, None)["items"]
+        self.assertEqual([item.id for item in liked], [copy.canonical_id])
+        liked = item_list(self.session, "liked", 0, self.mirror.id)["items"]
+        self.assertEqual([item.id for item in liked], [copy.id])
+
+        toggle_like(self.session, copy.canonical_id)
+        self.session.expire_all()
+        self.assertEqual(self.session.query(Item).filter(Item.liked != None).count(), 0)
+
+    def test_deleting_canonical_feed_promotes_copy(self):
+        delete_feed(self.session, self.original.id)
+        self.session.expire_all()
+        (copy,) = self._items(self.mirror)
+        self.assertIsNone(copy.canonical_id)
+        fingerprints = self.session.query(ItemFingerprint).all()
+        self.assertEqual([f.item_id for f in fingerprints], [copy.id])
+
+    def test_deleting_canonical_feed_promotes_first_of_several_copies(self):
+        second_mirror = Feed(url=self.server.url("/second-mirror"))
+        self.session.add(second_mirror)
+        self.session.commit()
+        update_feed(self.session, second_mirror)
+        self.session.commit()
+        delete_feed(self.session, self.original.id)
+        self.session.expire_all()
+        (copy,) = self._items(self.mirror)
+        (second_copy,) = self._items(second_mirror)
+        self.assertIsNone(copy.canonical_id)
+        self.assertEqual(second_copy.canonical_id, copy.id)
+        fingerprints = self.session.query(ItemFingerprint).all()
+        self.assertEqual([f.item_id for f in fingerprints], [copy.id])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,3 @@
-import os
 import unittest
 
 from sqlalchemy import create_engine
@@ -6,8 +5,6 @@ from sqlalchemy.orm import sessionmaker
 
 from models import Base, Feed
 
-os.makedirs("instance", exist_ok=True)
-
 from logic import update_feed_title
 
 
@@ -0,0 +1,213 @@
+import os
+import struct
+import tempfile
+import unittest
+import warnings
+import zlib
+from unittest import mock
+
+from sqlalchemy.exc import SAWarning
+from sqlalchemy.orm import sessionmaker
+
+import image_proxy
+from image_proxy import ImageCache, image_key, rewrite_image_urls
+from local_server import LocalServer, hours_ago
+from models import Feed, Item, ProxiedImage
+
+# bound to the database chosen in conftest.py
+import server
+from update import update_feed
+
+
+def png(width=1, height=1):
+    """A minimal valid black PNG image."""
+
+    def chunk(kind, data):
+        return (
+            struct.pack(">I", len(data))
+            + kind
+            + data
+            + struct.pack(">I", zlib.crc32(kind + data))
+        )
+
+    raw = b"".join(b"\x00" + b"\x00" * width for _ in range(height))
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw))
+        + chunk(b"IEND", b"")
+    )
+
+
+class RewriteImageUrlsTests(unittest.TestCase):
+    def test_rewrites_remote_src_and_srcset(self):
+        html, images = rewrite_image_urls(
+            '<p>hi</p><img src="https://a.example/x.png" '
+            'srcset="https://a.example/x1.png 1x, https://a.example/x2.png 2x">'
+        )
+        self.assertEqual(
+            set(images.values()),
+            {
+                "https://a.example/x.png",
+                "https://a.example/x1.png",
+                "https://a.example/x2.png",
+            },
+        )
+        self.assertNotIn("a.example", html)
+        self.assertIn(f'src="/img/{image_key("https://a.example/x.png")}"', html)
+        self.assertIn(f"/img/{image_key('https://a.example/x2.png')} 2x", html)
+
+    def test_leaves_other_markup_alone(self):
+        source = '<a href="https://a.example/x.png">link</a><img src="data:,">'
+        self.assertEqual(rewrite_image_urls(source), (source, {}))
+        self.assertEqual(rewrite_image_urls(None), (None, {}))
+
+
+class ImageCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.image = png(4, 4)
+        self.server = LocalServer(
+            {
+                "/a.png": (200, {"Content-Type": "image/png"}, self.image),
+                "/b.png": (200, {"Content-Type": "image/png"}, png(8, 8)),
+                "/page": (200, {"Content-Type": "text/html"}, b"<script></script>"),
+            }
+        ).__enter__()
+
+    def tearDown(self):
+        self.server.__exit__()
+        self.tmpdir.cleanup()
+
+    def _fetch(self, cache, path):
+        url = self.server.url(path)
+        return cache.fetch(image_key(url), url)
+
+    def test_image_is_fetched_once(self):
+        cache = ImageCache(self.tmpdir.name)
+        self.assertEqual(self._fetch(cache, "/a.png"), (self.image, "image/png"))
+        self.assertEqual(self._fetch(cache, "/a.png"), (self.image, "image/png"))
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_non_images_are_not_cached(self):
+        cache = ImageCache(self.tmpdir.name)
+        self.assertIsNone(self._fetch(cache, "/page"))
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    def test_least_recently_used_images_are_evicted(self):
+        cache = ImageCache(self.tmpdir.name, max_bytes=len(self.image) + 10)
+        a_key = image_key(self.server.url("/a.png"))
+        self._fetch(cache, "/a.png")
+        os.utime(cache.path(a_key), (0, 0))
+        self._fetch(cache, "/b.png")
+        self.assertIsNone(cache.get(a_key))
+        self.assertIsNotNone(cache.get(image_key(self.server.url("/b.png"))))
+
+    def test_directory_is_created_on_first_fetch(self):
+        directory = os.path.join(self.tmpdir.name, "image_cache")
+        cache = ImageCache(directory)
+        self.assertFalse(os.path.exists(directory))
+        self.assertIsNone(cache.get(image_key(self.server.url("/a.png"))))
+        self.assertEqual(self._fetch(cache, "/a.png"), (self.image, "image/png"))
+        self.assertEqual(len(os.listdir(directory)), 1)
+
+    def test_keys_that_are_not_digests_are_refused(self):
+        cache = ImageCache(self.tmpdir.name)
+        for key in ("..", "../rss_feeds.db", "A" * 64, "a" * 63):
+            with self.assertRaises(ValueError):
+                cache.get(key)
+
+
+class ProxyRouteTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.image = png(4, 4)
+        self.server = LocalServer(
+            {
+                "/a.png": (200, {"Content-Type": "image/png"}, self.image),
+                "/gone.png": (404, {}, b""),
+                "/feed": lambda handler: (200, {}, self.feed_body),
+            }
+        ).__enter__()
+        self.cache = ImageCache(self.tmpdir.name)
+        patcher = mock.patch.object(server, "image_cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        with server.app.app_context():
+            self.session = sessionmaker(bind=server.db.engine)()
+        self.client = server.app.test_client()
+
+    def tearDown(self):
+        self.session.query(ProxiedImage).delete()
+        self.session.commit()
+        self.session.close()
+        self.server.__exit__()
+        self.tmpdir.cleanup()
+
+    def proxy(self, path):
+        url = self.server.url(path)
+        key = image_key(url)
+        self.session.add(ProxiedImage(key=key, url=url))
+        self.session.commit()
+        return key, url
+
+    def test_miss_then_hit(self):
+        key, _ = self.proxy("/a.png")
+        for _ in range(2):
+            response = self.client.get(f"/img/{key}")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, "image/png")
+            self.assertEqual(response.get_data(), self.image)
+            self.assertIn("immutable", response.headers["Cache-Control"])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_redirects_to_the_original_when_the_fetch_fails(self):
+        key, url = self.proxy("/gone.png")
+        response = self.client.get(f"/img/{key}")
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.headers["Location"], url)
+
+    def test_bad_and_unknown_keys(self):
+        # a file in the cache directory that no item refers to
+        stray = image_key("https://example.com/stray.png")
+        with open(os.path.join(self.tmpdir.name, stray), "wb") as f:
+            f.write(self.image)
+        for key in ("..", "%2e%2e", "A" * 64, "a" * 65, stray):
+            self.assertEqual(self.client.get(f"/img/{key}").status_code, 404, key)
+        self.assertEqual(self.server.requests, [])
+
+    def test_images_are_rewritten_at_ingest(self):
+        image_url = self.server.url("/a.png")
+        description = f'<p>Look</p><img src="{image_url}">'
+        self.feed_body = (
+            '<?xml version="1.0"?><rss version="2.0"><channel><title>Images</title>'
+            "<item><title>Pictured</title><link>https://example.com/pictured</link>"
+            f"<pubDate>{hours_ago(1)}</pubDate>"
+            f"<description><![CDATA[{description}]]></description></item>"
+            "</channel></rss>"
+        ).encode("utf-8")
+        feed = Feed(url=self.server.url("/feed"))
+        self.session.add(feed)
+        self.session.commit()
+        self.addCleanup(self.delete, feed)
+        with mock.patch.object(image_proxy, "PROXY_IMAGES", True):
+            with warnings.catch_warnings():
+                # e.g. the new items being flushed before they were added
+                warnings.simplefilter("error", SAWarning)
+                update_feed(self.session, feed)
+        self.session.commit()
+
+        (item,) = self.session.query(Item).filter_by(feed_id=feed.id)
+        key = image_key(image_url)
+        self.assertNotIn(image_url, item.description)
+        self.assertIn(f'src="/img/{key}"', item.description)
+        self.assertEqual(self.session.get(ProxiedImage, key).url, image_url)
+        self.assertEqual(self.client.get(f"/img/{key}").get_data(), self.image)
+
+    def delete(self, feed):
+        self.session.delete(feed)
+        self.session.commit()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,194 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime
+from unittest import mock
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import models
+from models import Base, BackupStat, UpdateStat, migrate, schema_is_current
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class MigrateTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmpdir.name, "old.db")
+        engine = create_engine(f"sqlite:///{self.db_path}")
+        Base.metadata.create_all(engine)
+        engine.dispose()
+        # an older schema: a column and indexes that were added later are missing
+        db = sqlite3.connect(self.db_path)
+        db.execute("ALTER TABLE feed DROP COLUMN bytes_decoded")
+        db.execute("DROP INDEX ix_item_copies")
+        db.execute("CREATE INDEX ix_item_published ON item (published)")
+        # stats were keyed by their timestamp alone, before there were instances
+        db.execute("DROP TABLE update_stats")
+        db.execute(
+            "CREATE TABLE update_stats (timestamp DATETIME NOT NULL PRIMARY KEY, "
+            "num_feeds INTEGER NOT NULL, num_fetched INTEGER NOT NULL, "
+            "num_updated INTEGER NOT NULL, num_failed INTEGER NOT NULL, "
+            "num_new_items INTEGER NOT NULL, dur_total FLOAT NOT NULL, "
+            "dur_min_feed FLOAT NOT NULL, dur_min_feed_id FLOAT, "
+            "dur_avg_feed FLOAT NOT NULL, dur_std_feed FLOAT NOT NULL, "
+            "dur_max_feed FLOAT NOT NULL, dur_max_feed_id FLOAT)"
+        )
+        db.execute(
+            "INSERT INTO update_stats VALUES "
+            "('2024-01-01 10:00:00.000000', 3, 3, 1, 0, 2, 1.5, 0.1, 1, 0.5, 0.1, 1, 2)"
+        )
+        # backups recorded how often they restarted, before they were taken in one step
+        db.execute("DROP TABLE backup_stats")
+        db.execute(
+            "CREATE TABLE backup_stats (timestamp DATETIME NOT NULL PRIMARY KEY, "
+            "path VARCHAR(512) NOT NULL, num_pages INTEGER NOT NULL, "
+            "num_restarts INTEGER NOT NULL, size INTEGER NOT NULL, "
+            "stored_size INTEGER NOT NULL, checksum VARCHAR(64) NOT NULL, "
+            "dur FLOAT NOT NULL)"
+        )
+        db.execute(
+            "INSERT INTO backup_stats VALUES "
+            "('2024-01-01 10:00:00.000000', 'old.db.gz', 4, 2, 4096, 512, '', 0.5)"
+        )
+        db.commit()
+        db.close()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def is_current(self):
+        engine = create_engine(f"sqlite:///{self.db_path}")
+        with engine.connect() as conn:
+            current = schema_is_current(conn)
+        engine.dispose()
+        return current
+
+    def test_concurrent_migrations(self):
+        # e.g. every gunicorn worker, the ASGI app and the updater starting together
+        script = (
+            "import sys, sqlalchemy, models; "
+            "models.migrate(sqlalchemy.create_engine(f'sqlite:///{sys.argv[1]}'))"
+        )
+        processes = [
+            subprocess.Popen(
+                [sys.executable, "-c", script, self.db_path],
+                env={**os.environ, "PYTHONPATH": REPO},
+                stderr=subprocess.PIPE,
+            )
+            for _ in range(5)
+        ]
+        for process in processes:
+            _, stderr = process.communicate(timeout=60)
+            self.assertEqual(process.returncode, 0, stderr.decode())
+        self.assertTrue(self.is_current())
+        with sqlite3.connect(self.db_path) as db:
+            self.assertEqual(db.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        db.close()
+
+    def test_update_stats_are_keyed_by_timestamp_and_instance(self):
+        engine = create_engine(f"sqlite:///{self.db_path}")
+        migrate(engine)
+        session = sessionmaker(bind=engine)()
+        (old,) = session.query(UpdateStat).all()
+        self.assertEqual((old.instance, old.num_new_items, old.dur_total), ("", 2, 1.5))
+        stats = dict(
+            num_feeds=1,
+            num_fetched=1,
+            num_updated=0,
+            num_failed=0,
+            num_new_items=0,
+            dur_total=1.0,
+            dur_min_feed=1.0,
+            dur_avg_feed=1.0,
+            dur_std_feed=0.0,
+            dur_max_feed=1.0,
+        )
+        # instances started by the same timer tick may record the same timestamp
+        session.add_all(
+            UpdateStat(timestamp=old.timestamp, instance=instance, **stats)
+            for instance in ("host-a:1", "host-b:1")
+        )
+        session.commit()
+        self.assertEqual(session.query(UpdateStat).count(), 3)
+        session.close()
+        engine.dispose()
+
+    def test_backup_restarts_are_no_longer_recorded(self):
+        engine = create_engine(f"sqlite:///{self.db_path}")
+        migrate(engine)
+        session = sessionmaker(bind=engine)()
+        (old,) = session.query(BackupStat).all()
+        self.assertEqual((old.path, old.num_pages), ("old.db.gz", 4))
+        session.add(
+            BackupStat(
+                timestamp=datetime.now(),
+                path="new.db.gz",
+                num_pages=4,
+                size=4096,
+                stored_size=512,
+                checksum="0" * 64,
+                dur=0.1,
+            )
+        )
+        session.commit()
+        self.assertEqual(session.query(BackupStat).count(), 2)
+        session.close()
+        engine.dispose()
+
+    def test_later_migrations_wait_for_the_first(self):
+        migrations, errors = [], []
+        started, finish = threading.Event(), threading.Event()
+        migrate_schema = models.migrate_schema
+
+        def slow_migrate_schema(conn):
+            migrations.append(conn)
+            started.set()
+            finish.wait(5)
+            migrate_schema(conn)
+
+        def run():
+            try:
+                migrate(create_engine(f"sqlite:///{self.db_path}"))
+            except Exception as e:
+                errors.append(e)
+
+        with mock.patch.object(models, "migrate_schema", slow_migrate_schema):
+            first, second = threading.Thread(target=run), threading.Thread(target=run)
+            first.start()
+            started.wait(5)
+            second.start()
+            # the second finds the schema outdated, and waits for the lock
+            time.sleep(0.2)
+            finish.set()
+            first.join()
+            second.join()
+        self.assertEqual(errors, [])
+        # the second checked again once it had the lock, and had nothing to do
+        self.assertEqual(len(migrations), 1)
+        self.assertTrue(self.is_current())
+
+    def test_current_schema_is_not_locked(self):
+        migrate(create_engine(f"sqlite:///{self.db_path}"))
+        writer = sqlite3.connect(self.db_path, isolation_level=None)
+        writer.execute("BEGIN IMMEDIATE")
+        try:
+            engine = create_engine(
+                f"sqlite:///{self.db_path}", connect_args={"timeout": 0.1}
+            )
+            migrate(engine)
+            engine.dispose()
+        finally:
+            writer.rollback()
+            writer.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,298 @@
+"""
+Checks the SQLite query plan of every query issued by the read and write paths
+against a seeded database, so that schema or query changes cannot silently
+degrade them. Each query fails if it does a full scan of a table or sorts with
+a temporary B-tree for ORDER BY (unless that is explicitly allowed below), or if
+its plan differs from the one recorded in query_plans.json (for the same
+SQLite version and database size).
+
+Set UPDATE_QUERY_PLANS=1 to record new plans after an intentional change, and
+QUERY_PLAN_ITEMS to change the size of the seeded database.
+"""
+
+import json
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import sessionmaker
+
+from models import Base, Feed, Item
+
+import logic
+from update import (
+    claim_feeds,
+    get_last_published_date,
+    link_duplicate_items,
+    renew_leases,
+)
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "query_plans.json")
+UPDATE_BASELINE = os.environ.get("UPDATE_QUERY_PLANS") == "1"
+
+NUM_FEEDS = 200
+NUM_ITEMS = int(os.environ.get("QUERY_PLAN_ITEMS", 50_000))
+NUM_DAYS = 365
+
+FULL_SCAN_RE = re.compile(r"^SCAN (?:TABLE )?(\w+)$")
+TEMP_ORDER_BY_RE = re.compile(r"TEMP B-TREE FOR .*ORDER BY")
+
+
+def seed(engine):
+    rng = random.Random(0)
+    now = datetime.now()
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "INSERT INTO feed (id, url, title, last_updated, downrank) "
+                "VALUES (:id, :url, :title, :last_updated, :downrank)"
+            ),
+            [
+                {
+                    "id": i,
+                    "url": f"https://example.com/{i}/feed",
+                    "title": f"Feed {i}",
+                    "last_updated": now - timedelta(hours=rng.random() * 24),
+                    "downrank": rng.random() < 0.1,
+                }
+                for i in range(1, NUM_FEEDS + 1)
+            ],
+        )
+        items = []
+        for i in range(1, NUM_ITEMS + 1):
+            # most items are recent, like a reader that has been running for a while
+            published = now - timedelta(days=NUM_DAYS * rng.random() ** 2)
+            read_at = published + timedelta(hours=rng.random() * 48)
+            items.append(
+                {
+                    "id": i,
+                    "title": f"Item {i}",
+                    "link": f"https://example.com/items/{i}",
+                    "published": published,
+                    "feed_id": rng.randint(1, NUM_FEEDS),
+                    "visited": read_at if rng.random() < 0.6 else None,
+                    "liked": read_at if rng.random() < 0.02 else None,
+                    "dismissed": read_at if rng.random() < 0.1 else None,
+                    "canonical_id": (
+                        rng.randint(1, i - 1) if i > 1 and rng.random() < 0.05 else None
+                    ),
+                }
+            )
+        conn.execute(
+            text(
+                "INSERT INTO item (id, title, link, published, feed_id, visited, liked, dismissed, canonical_id) "
+                "VALUES (:id, :title, :link, :published, :feed_id, :visited, :liked, :dismissed, :canonical_id)"
+            ),
+            items,
+        )
+        conn.execute(
+            text(
+                "INSERT INTO update_stats (timestamp, instance, num_feeds, num_fetched, num_updated, num_failed, "
+                "num_new_items, dur_total, dur_min_feed, dur_min_feed_id, dur_avg_feed, dur_std_feed, "
+                "dur_max_feed, dur_max_feed_id) VALUES (:timestamp, '', 200, 200, 50, 1, 30, 12.5, 10, 1, "
+                "150, 40, 2000, 2)"
+            ),
+            [{"timestamp": now - timedelta(hours=h)} for h in range(24 * 60)],
+        )
+
+
+class QueryPlanTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.engine = create_engine(
+            f"sqlite:///{os.path.join(cls.tmpdir.name, 'plans.db')}"
+        )
+        Base.metadata.create_all(cls.engine)
+        seed(cls.engine)
+        # like models.migrate and the updater's PRAGMA optimize do for real databases
+        with cls.engine.begin() as conn:
+            conn.execute(text("ANALYZE"))
+        cls.statements = None
+
+        @event.listens_for(cls.engine, "before_cursor_execute")
+        def record_statement(conn, cursor, statement, parameters, context, many):
+            if cls.statements is not None and not many:
+                cls.statements.append((statement, parameters))
+
+        cls.timings = {}
+        cls.plans = {}
+        if os.path.exists(BASELINE_PATH):
+            with open(BASELINE_PATH) as f:
+                cls.baseline = json.load(f)
+        else:
+            cls.baseline = {"sqlite_version": None, "num_items": None, "plans": {}}
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.engine.dispose()
+        cls.tmpdir.cleanup()
+        if UPDATE_BASELINE:
+            with open(BASELINE_PATH, "w") as f:
+                json.dump(
+                    {
+                        "sqlite_version": sqlite3.sqlite_version,
+                        "num_items": NUM_ITEMS,
+                        "plans": cls.plans,
+                    },
+                    f,
+                    indent=2,
+                    sort_keys=True,
+                )
+                f.write("\n")
+        print(f"\nquery timings with {NUM_ITEMS} items:")
+        for name, dur in sorted(cls.timings.items()):
+            print(f"  {name:32} {dur * 1000:8.2f}ms")
+
+    def setUp(self):
+        self.session = sessionmaker(bind=self.engine)()
+
+    def tearDown(self):
+        self.session.close()
+
+    def check_plans(self, name, fn, *, allow_scan=(), allow_order_by_sort=False):
+        """
+        Run `fn` with a session, then check the plan of every query it issued.
+        The distinct plans are compared against the recorded baseline.
+        """
+        type(self).statements = []
+        start = time.perf_counter()
+        fn(self.session)
+        self.timings[name] = time.perf_counter() - start
+        statements, type(self).statements = type(self).statements, None
+
+        plans = []
+        with self.engine.connect() as conn:
+            for statement, parameters in statements:
+                if not statement.lstrip().startswith(("SELECT", "UPDATE", "DELETE")):
+                    continue
+                plan = [
+                    row[-1]
+                    for row in conn.exec_driver_sql(
+                        "EXPLAIN QUERY PLAN " + statement, parameters
+                    )
+                ]
+                if plan not in plans:
+                    plans.append(plan)
+                for detail in plan:
+                    scan = FULL_SCAN_RE.match(detail)
+                    if scan and scan.group(1) in Base.metadata.tables:
+                        self.assertIn(
+                            scan.group(1),
+                            allow_scan,
+                            f"{name} does a full scan of {scan.group(1)}:\n{statement}",
+                        )
+                    if TEMP_ORDER_BY_RE.search(detail):
+                        self.assertTrue(
+                            allow_order_by_sort,
+                            f"{name} sorts with a temporary B-tree:\n{statement}",
+                        )
+        self.assertTrue(plans, f"{name} issued no queries")
+        self.plans[name] = plans
+
+        # SQLite may choose between equally good indexes differently depending on
+        # its version and the size of the tables, so only compare like with like
+        if (
+            not UPDATE_BASELINE
+            and self.baseline["sqlite_version"] == sqlite3.sqlite_version
+            and self.baseline["num_items"] == NUM_ITEMS
+        ):
+            self.assertEqual(
+                plans,
+                self.baseline["plans"].get(name),
+                f"query plan of {name} changed; "
+                "rerun with UPDATE_QUERY_PLANS=1 if this is intended",
+            )
+
+    def test_overview(self):
+        # feeds are ranked by aggregates of their unread items, which no index can provide
+        self.check_plans("overview", logic.overview, allow_order_by_sort=True)
+
+    def test_item_list(self):
+        for state in ("all", "visited", "liked"):
+            for offset in (0, 20 * logic.PAGE_SIZE):
+                self.check_plans(
+                    f"item_list_{state}_{offset}",
+                    lambda s: logic.item_list(s, state, offset, None),
+                )
+
+    def test_item_list_for_feed(self):
+        for state in ("all", "visited", "liked"):
+            self.check_plans(
+                f"item_list_{state}_feed",
+                lambda s: logic.item_list(s, state, logic.PAGE_SIZE, 7),
+            )
+
+    def test_unvisited_items_after(self):
+        self.check_plans(
+            "unvisited_items_after",
+            lambda s: logic.unvisited_items_after(
+                s, datetime.now() - timedelta(days=7)
+            ),
+        )
+
+    def test_get_last_published_date(self):
+        self.check_plans(
+            "get_last_published_date",
+            lambda s: get_last_published_date(s, s.get(Feed, 3)),
+        )
+
+    def test_fetch_update_stats(self):
+        for timeframe in ("day", "week", "month"):
+            self.check_plans(
+                f"fetch_update_stats_{timeframe}",
+                lambda s: logic.fetch_update_stats(s, timeframe),
+            )
+
+    def test_feed_list(self):
+        self.check_plans("feed_list", logic.feed_list)
+
+    def test_flush_visits(self):
+        def visit(session):
+            for item_id in (11, 12, 13, 14):
+                logic.record_visit(session, item_id)
+            logic.flush_visits(session)
+
+        self.check_plans("flush_visits", visit)
+
+    def test_record_dismiss_and_like(self):
+        self.check_plans("record_dismiss", lambda s: logic.record_dismiss(s, 21))
+        self.check_plans("toggle_like", lambda s: logic.toggle_like(s, 22))
+
+    def test_link_duplicate_items(self):
+        def ingest(session):
+            items = [
+                Item(
+                    title=f"New {i}",
+                    link=f"https://example.com/new/{i}",
+                    published=datetime.now(),
+                    feed_id=5,
+                )
+                for i in range(3)
+            ]
+            session.add_all(items)
+            session.flush()
+            link_duplicate_items(session, items)
+            session.rollback()
+
+        self.check_plans("link_duplicate_items", ingest)
+
+    def test_claim_feeds(self):
+        def claim(session):
+            claimed = claim_feeds(session, "plans", 16)
+            renew_leases(session, "plans", claimed)
+
+        self.check_plans("claim_feeds", claim)
+
+    def test_delete_feed(self):
+        self.check_plans("delete_feed", lambda s: logic.delete_feed(s, NUM_FEEDS))
+
+
+if __name__ == "__main__":
+    unittest.main()
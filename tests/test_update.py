@@ -1,13 +1,31 @@
+import gzip
 import os
+import subprocess
+import sys
+import threading
 import time
 import tempfile
 import unittest
+from datetime import datetime, timedelta
+from unittest import mock
 
+import pandas as pd
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
-from models import Base, Feed
-from update import update_feeds
+from models import Base, Feed, FeedLease, Item, WebSubPush
+from local_server import LocalServer, hours_ago, rss
+from logic import merge_instance_stats
+from parsing import parse_feed
+from update import (
+    FETCH_INTERVAL,
+    UPDATE_TIMER_INTERVAL,
+    brotli,
+    claim_feeds,
+    decode_body,
+    update_feed,
+    update_feeds,
+)
 
 
 class TestUpdateFeedsConcurrency(unittest.TestCase):
@@ -74,6 +92,489 @@ class TestUpdateFeedsConcurrency(unittest.TestCase):
         self.assertEqual(stats.num_updated, 1)
         self.assertEqual(stats.num_failed, 1)
 
+    def _update_within(self, seconds, session, **kwargs):
+        """Run update_feeds, failing rather than hanging if it never finishes."""
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(update_feeds(session, **kwargs)), daemon=True
+        )
+        thread.start()
+        thread.join(seconds)
+        self.assertFalse(thread.is_alive(), "update_feeds kept claiming feeds")
+        return result[0]
+
+    def test_pushes_are_added_when_the_fetch_fails(self):
+        session = self.Session()
+        feed = self._create_feed(session, "https://example.com/fails")
+        feed.last_fetched = datetime.now()
+        session.add(
+            WebSubPush(
+                feed_id=feed.id,
+                received=datetime.now(),
+                content_type="application/rss+xml",
+                body=rss(("Pushed", "https://example.com/pushed", hours_ago(1))),
+            )
+        )
+        session.commit()
+        attempts = []
+
+        def failing_update(worker_session, feed):
+            attempts.append(feed.id)
+            raise ValueError("boom")
+
+        stats = self._update_within(
+            10, session, update_fn=failing_update, max_workers=2, instance="a"
+        )
+
+        self.assertEqual(attempts, [feed.id])
+        self.assertEqual(stats.num_failed, 1)
+        session.expire_all()
+        self.assertEqual(session.query(Item.title).scalar(), "Pushed")
+        self.assertEqual(session.query(WebSubPush).count(), 0)
+
+    def test_a_push_that_fails_is_not_retried_in_the_same_run(self):
+        session = self.Session()
+        feed = self._create_feed(session, "https://example.com/fails")
+        feed.last_fetched = datetime.now()
+        session.add(WebSubPush(feed_id=feed.id, received=datetime.now(), body=b"<"))
+        session.commit()
+        attempts = []
+
+        def failing_update(worker_session, feed):
+            attempts.append(feed.id)
+            raise ValueError("boom")
+
+        with mock.patch("update.ingest_feed", side_effect=ValueError("bad push")):
+            self._update_within(10, session, update_fn=failing_update, instance="a")
+
+        self.assertEqual(attempts, [feed.id])
+        # kept for the feed's next regular fetch
+        self.assertEqual(session.query(WebSubPush).count(), 1)
+
+
+class TestUpdateFeedsSharding(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(
+            f"sqlite:///{os.path.join(self.tmpdir.name, 'test.db')}"
+        )
+        Base.metadata.create_all(self.engine)
+        self.Session = sessionmaker(bind=self.engine)
+        session = self.Session()
+        session.add_all(Feed(url=f"https://example.com/{i}") for i in range(12))
+        session.commit()
+        session.close()
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def test_concurrent_instances_fetch_each_feed_once(self):
+        fetched = []
+        fetched_lock = threading.Lock()
+
+        def slow_update(worker_session, feed):
+            time.sleep(0.05)
+            with fetched_lock:
+                fetched.append(feed.id)
+            return {"id": feed.id, "num_new_items": 0, "dur": 50, "cache_miss": False}
+
+        results = {}
+
+        def run(instance):
+            session = self.Session()
+            results[instance] = update_feeds(
+                session, update_fn=slow_update, max_workers=2, instance=instance
+            )
+            session.close()
+
+        threads = [threading.Thread(target=run, args=(name,)) for name in ("a", "b")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(fetched), list(range(1, 13)))
+        self.assertEqual(sum(r.num_fetched for r in results.values()), 12)
+        self.assertGreater(results["a"].num_fetched, 0)
+        self.assertGreater(results["b"].num_fetched, 0)
+        session = self.Session()
+        self.assertEqual(
+            session.query(FeedLease).filter(FeedLease.owner != None).count(), 0
+        )
+        self.assertEqual(
+            session.query(Feed).filter(Feed.last_fetched == None).count(), 0
+        )
+        session.close()
+
+        # every feed was just fetched, so none are due again yet
+        session = self.Session()
+        stats = update_feeds(session, update_fn=slow_update, instance="c")
+        self.assertEqual(stats.num_fetched, 0)
+        session.close()
+
+    def test_feeds_are_due_at_every_timer_run(self):
+        repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with open(os.path.join(repo, "systemd", "rsrssr-update.timer")) as f:
+            timer = dict(
+                line.strip().split("=", 1)
+                for line in f
+                if "=" in line and "#" not in line
+            )
+        self.assertEqual(timer["FixedRandomDelay"], "true")
+        self.assertTrue(timer["OnCalendar"].endswith(":00:00"))
+        self.assertLess(FETCH_INTERVAL, UPDATE_TIMER_INTERVAL)
+        self.assertEqual(UPDATE_TIMER_INTERVAL, timedelta(hours=1))
+
+    def test_only_expired_leases_can_be_claimed(self):
+        session = self.Session()
+        now = datetime.now()
+        session.add_all(
+            [
+                FeedLease(feed_id=1, owner="a", expires=now + timedelta(minutes=1)),
+                FeedLease(feed_id=2, owner="a", expires=now - timedelta(minutes=1)),
+            ]
+        )
+        session.commit()
+
+        claimed = claim_feeds(session, "b", 100, now)
+
+        self.assertNotIn(1, claimed)
+        self.assertIn(2, claimed)
+        self.assertEqual(len(claimed), 11)
+        self.assertEqual(claim_feeds(session, "c", 100, now), [])
+        session.close()
+
+
+class TestMergeInstanceStats(unittest.TestCase):
+    def _stats(self, timestamp, instance, num_fetched, avg, std, fastest, slowest):
+        return {
+            "timestamp": timestamp,
+            "instance": instance,
+            "num_feeds": 10,
+            "num_fetched": num_fetched,
+            "num_updated": 1,
+            "num_failed": 0,
+            "num_new_items": 2,
+            "dur_total": num_fetched,
+            "dur_min_feed": fastest,
+            "dur_min_feed_id": num_fetched,
+            "min_feed_url": f"{instance}-fastest",
+            "dur_avg_feed": avg,
+            "dur_std_feed": std,
+            "dur_max_feed": slowest,
+            "dur_max_feed_id": num_fetched,
+            "max_feed_url": f"{instance}-slowest",
+            "bytes_received": 100 * num_fetched,
+            "bytes_decoded": 300 * num_fetched,
+            "bytes_saved": 250 * num_fetched,
+        }
+
+    def test_instances_of_one_run_are_merged(self):
+        run = datetime(2024, 1, 1, 12, 0)
+        data = pd.DataFrame(
+            [
+                self._stats(run, "a", 4, 10.0, 2.0, 7, 13),
+                self._stats(run + timedelta(seconds=5), "b", 6, 20.0, 3.0, 5, 30),
+                self._stats(run + timedelta(hours=1), "a", 10, 15.0, 1.0, 12, 18),
+            ]
+        )
+        merged = merge_instance_stats(data)
+
+        self.assertEqual(len(merged), 2)
+        first = merged.iloc[0]
+        self.assertEqual(first["num_instances"], 2)
+        self.assertEqual(first["num_feeds"], 10)
+        self.assertEqual(first["num_fetched"], 10)
+        self.assertEqual(first["num_new_items"], 4)
+        self.assertEqual(first["dur_total"], 6)
+        self.assertEqual(
+            (first["bytes_received"], first["bytes_decoded"], first["bytes_saved"]),
+            (1000, 3000, 2500),
+        )
+        self.assertAlmostEqual(first["dur_avg_feed"], 16.0)
+        # pooled over both instances: (3*4 + 5*9 + 4*36 + 6*16) / 9
+        self.assertAlmostEqual(first["dur_std_feed"], (297 / 9) ** 0.5)
+        self.assertEqual(
+            (first["dur_min_feed"], first["min_feed_url"]), (5, "b-fastest")
+        )
+        self.assertEqual(
+            (first["dur_max_feed"], first["max_feed_url"]), (30, "b-slowest")
+        )
+        self.assertEqual(merged.iloc[1]["num_instances"], 1)
+        self.assertAlmostEqual(merged.iloc[1]["dur_avg_feed"], 15.0)
+
+
+class TestUpdateFeedChangeDetection(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite:///:memory:")
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.body = rss(("Post", "https://example.com/post", hours_ago(2)))
+        self.server = LocalServer()
+        self.server.__enter__()
+
+    def tearDown(self):
+        self.server.__exit__()
+        self.session.close()
+
+    def _update(self, feed):
+        stats = update_feed(self.session, feed)
+        self.session.commit()
+        return stats
+
+    def test_unchanged_body_without_validators_skips_parsing(self):
+        self.server.routes["/feed"] = (200, {}, self.body)
+        feed = Feed(url=self.server.url("/feed"))
+        self.session.add(feed)
+        self.session.commit()
+
+        first = self._update(feed)
+        self.assertTrue(first["cache_miss"])
+        self.assertEqual(first["num_new_items"], 1)
+
+        with mock.patch("update.feedparser.parse") as parse:
+            second = self._update(feed)
+        parse.assert_not_called()
+        self.assertFalse(second["cache_miss"])
+        self.assertEqual(self.session.query(Item).count(), 1)
+
+    def test_changed_body_is_parsed(self):
+        self.server.routes["/feed"] = (200, {}, self.body)
+        feed = Feed(url=self.server.url("/feed"))
+        self.session.add(feed)
+        self.session.commit()
+        self._update(feed)
+
+        self.server.routes["/feed"] = (
+            200,
+            {},
+            rss(
+                ("Newer", "https://example.com/newer", hours_ago(1)),
+                ("Post", "https://example.com/post", hours_ago(2)),
+            ),
+        )
+        stats = self._update(feed)
+        self.assertTrue(stats["cache_miss"])
+        self.assertEqual(stats["num_new_items"], 1)
+
+    def test_sends_validators_and_honours_not_modified(self):
+        def conditional(handler):
+            if handler.headers.get("If-None-Match") == '"v1"':
+                return 304, {}, b""
+            return 200, {"ETag": '"v1"'}, self.body
+
+        self.server.routes["/feed"] = conditional
+        feed = Feed(url=self.server.url("/feed"))
+        self.session.add(feed)
+        self.session.commit()
+
+        self.assertTrue(self._update(feed)["cache_miss"])
+        self.assertEqual(feed.etag, '"v1"')
+        self.assertFalse(self._update(feed)["cache_miss"])
+
+
+class TestDeltaFeeds(unittest.TestCase):
+    """Fetching from a server that supports gzip and RFC 3229 feed deltas."""
+
+    def setUp(self):
+        # update_feeds fetches in threads with their own connections
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(
+            f"sqlite:///{os.path.join(self.tmpdir.name, 'test.db')}"
+        )
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        # newest first; the ETag of a version is the number of entries in it
+        self.entries = [
+            (f"Post {i}", f"https://example.com/{i}", hours_ago(100 - i))
+            for i in reversed(range(20))
+        ]
+        self.server = LocalServer({"/feed": self.respond})
+        self.server.__enter__()
+        self.feed = Feed(url=self.server.url("/feed"))
+        self.session.add(self.feed)
+        self.session.commit()
+
+    def tearDown(self):
+        self.server.__exit__()
+        self.session.close()
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def request_headers(self, i):
+        _, _, headers, _ = self.server.requests[i]
+        return {key.lower(): value for key, value in headers.items()}
+
+    def respond(self, handler):
+        etag = handler.headers.get("If-None-Match", "").strip('"')
+        headers = {"ETag": f'"{len(self.entries)}"'}
+        if etag == str(len(self.entries)):
+            return 304, headers, b""
+        if "feed" in handler.headers.get("A-IM", "") and etag.isdigit():
+            status = 226
+            headers["IM"] = "feed"
+            body = rss(*self.entries[: len(self.entries) - int(etag)])
+        else:
+            status = 200
+            body = rss(*self.entries)
+        if "gzip" in handler.headers.get("Accept-Encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+            body = gzip.compress(body)
+        return status, headers, body
+
+    def _update(self):
+        stats = update_feed(self.session, self.feed)
+        self.session.commit()
+        return stats
+
+    def test_full_fetch_is_compressed_and_counted(self):
+        stats = self._update()
+
+        headers = self.request_headers(0)
+        self.assertEqual(headers["a-im"], "feed")
+        self.assertIn("gzip", headers["accept-encoding"])
+        self.assertEqual(stats["num_new_items"], 20)
+        self.assertEqual(stats["bytes_decoded"], len(rss(*self.entries)))
+        self.assertLess(stats["bytes_received"], stats["bytes_decoded"])
+        self.assertEqual(
+            stats["bytes_saved"], stats["bytes_decoded"] - stats["bytes_received"]
+        )
+        self.assertEqual(self.feed.document_size, stats["bytes_decoded"])
+        self.assertEqual(self.feed.bytes_received, stats["bytes_received"])
+        self.assertEqual(self.feed.bytes_decoded, stats["bytes_decoded"])
+
+    def test_delta_merges_only_new_entries(self):
+        first = self._update()
+        self.entries.insert(0, ("Newest", "https://example.com/newest", hours_ago(1)))
+
+        stats = self._update()
+
+        self.assertEqual(self.request_headers(1)["if-none-match"], '"20"')
+        self.assertEqual(stats["num_new_items"], 1)
+        self.assertEqual(self.session.query(Item).count(), 21)
+        self.assertEqual(self.feed.etag, '"21"')
+        self.assertIsNone(self.feed.content_hash)
+        self.assertLess(stats["bytes_decoded"], first["bytes_decoded"] / 5)
+        # the size of the full document is kept from the last full fetch
+        self.assertEqual(self.feed.document_size, first["bytes_decoded"])
+        self.assertEqual(
+            stats["bytes_saved"], first["bytes_decoded"] - stats["bytes_received"]
+        )
+        self.assertEqual(
+            self.feed.bytes_received, first["bytes_received"] + stats["bytes_received"]
+        )
+
+        not_modified = self._update()
+        self.assertFalse(not_modified["cache_miss"])
+        self.assertEqual(not_modified["bytes_received"], 0)
+        self.assertEqual(not_modified["bytes_saved"], first["bytes_decoded"])
+
+    def test_unknown_instance_manipulation_is_an_error(self):
+        self.server.routes["/feed"] = (226, {"IM": "vcdiff"}, b"")
+        with self.assertRaises(ValueError):
+            self._update()
+
+    @unittest.skipIf(brotli is None, "brotli is not installed")
+    def test_brotli(self):
+        body = rss(*self.entries)
+        self.server.routes["/feed"] = (
+            200,
+            {"Content-Encoding": "br"},
+            brotli.compress(body),
+        )
+        stats = self._update()
+        self.assertEqual(stats["num_new_items"], 20)
+        self.assertEqual(stats["bytes_decoded"], len(body))
+
+    def test_brotli_is_unsupported_without_the_package(self):
+        with mock.patch("update.brotli", None):
+            with self.assertRaisesRegex(ValueError, "unsupported content encoding"):
+                decode_body(b"\x0b\x00\x80", "br")
+
+    def test_update_stat_records_bandwidth(self):
+        self.session.add(Feed(url=self.server.url("/feed")))
+        self.session.commit()
+
+        first = update_feeds(self.session, max_workers=2, parse_workers=0)
+        self.assertGreater(first.bytes_received, 0)
+        self.assertGreater(first.bytes_decoded, first.bytes_received)
+
+        self.entries.insert(0, ("Newest", "https://example.com/newest", hours_ago(1)))
+        # make both feeds due again
+        self.session.query(Feed).update({Feed.last_fetched: None})
+        self.session.commit()
+        second = update_feeds(self.session, max_workers=2, parse_workers=0)
+        self.assertEqual(second.num_new_items, 2)
+        self.assertLess(second.bytes_received, first.bytes_received)
+        self.assertLess(second.bytes_decoded, first.bytes_decoded / 5)
+        self.assertEqual(
+            second.bytes_saved, first.bytes_decoded - second.bytes_received
+        )
+
+
+class TestParseStage(unittest.TestCase):
+    def test_parse_feed_returns_entries_after_high_water_mark(self):
+        body = rss(
+            ("Newer", "https://example.com/newer", hours_ago(1)),
+            ("Older", "https://example.com/older", hours_ago(5)),
+            title="Parsed",
+        )
+        since = datetime.now() - timedelta(hours=3)
+        title, entries = parse_feed(body, {}, since)
+        self.assertEqual(title, "Parsed")
+        self.assertEqual(len(entries), 1)
+        entry_title, link, published, description, author = entries[0]
+        self.assertEqual((entry_title, link), ("Newer", "https://example.com/newer"))
+        self.assertGreater(published, since)
+
+    def test_update_feeds_parses_in_process_pool(self):
+        with tempfile.TemporaryDirectory() as tmpdir, LocalServer() as server:
+            engine = create_engine(f"sqlite:///{os.path.join(tmpdir, 'test.db')}")
+            Base.metadata.create_all(engine)
+            session = sessionmaker(bind=engine)()
+            for i in range(3):
+                server.routes[f"/{i}"] = (
+                    200,
+                    {},
+                    rss((f"Post {i}", f"https://example.com/{i}", hours_ago(1))),
+                )
+                session.add(Feed(url=server.url(f"/{i}")))
+            session.commit()
+
+            stats = update_feeds(session, max_workers=3, parse_workers=2)
+
+            self.assertEqual(stats.num_failed, 0)
+            self.assertEqual(stats.num_new_items, 3)
+            self.assertEqual(session.query(Item).count(), 3)
+            session.close()
+            engine.dispose()
+
+    def test_importing_has_no_side_effects(self):
+        # parse workers are spawned, and re-import the updater as __mp_main__
+        repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with tempfile.TemporaryDirectory() as cwd:
+            subprocess.run(
+                [sys.executable, "-c", "import update, parsing"],
+                cwd=cwd,
+                env={**os.environ, "PYTHONPATH": repo},
+                check=True,
+            )
+            self.assertEqual(os.listdir(cwd), [])
+
+    def test_importing_the_server_only_creates_its_database(self):
+        repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with tempfile.TemporaryDirectory() as cwd, tempfile.TemporaryDirectory() as db:
+            uri = f"sqlite:///{os.path.join(db, 'rss_feeds.db')}"
+            subprocess.run(
+                [sys.executable, "-c", "import server"],
+                cwd=cwd,
+                env={**os.environ, "PYTHONPATH": repo, "RSRSSR_DATABASE_URI": uri},
+                check=True,
+            )
+            # no instance/ folder (image cache, backups) next to where it ran
+            self.assertEqual(os.listdir(cwd), [])
+
 
 if __name__ == "__main__":
     unittest.main()
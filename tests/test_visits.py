@@ -0,0 +1,174 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+from datetime import datetime
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from models import Base, Feed, Item
+
+import logic
+from logic import (
+    flush_visits,
+    item_list,
+    overview,
+    record_visit,
+    unvisited_items_after,
+)
+from visit_log import VisitLog
+
+
+class VisitBufferTests(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite:///:memory:")
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        feed = Feed(url="http://example.com")
+        self.items = [
+            Item(
+                title=f"Item {i}",
+                link=f"http://example.com/{i}",
+                published=datetime.now(),
+                feed=feed,
+            )
+            for i in range(5)
+        ]
+        self.session.add_all(self.items)
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def _visited_ids(self):
+        self.session.expire_all()
+        return {
+            item.id for item in self.session.query(Item).filter(Item.visited != None)
+        }
+
+    def test_visits_are_buffered_until_flushed(self):
+        for item in self.items[:3]:
+            record_visit(self.session, item.id)
+        self.assertEqual(self._visited_ids(), set())
+
+        updates = []
+
+        @event.listens_for(self.engine, "before_cursor_execute")
+        def record_updates(conn, cursor, statement, *args):
+            if statement.startswith("UPDATE"):
+                updates.append(statement)
+
+        flush_visits(self.session)
+
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(self._visited_ids(), {item.id for item in self.items[:3]})
+        self.assertEqual(logic.visit_log(self.session).read(), {})
+
+    def test_reads_see_pending_visits(self):
+        record_visit(self.session, self.items[0].id)
+        visited = item_list(self.session, "visited", 0, None)["items"]
+        self.assertEqual([item.id for item in visited], [self.items[0].id])
+        self.assertIsNotNone(visited[0].visited)
+        (feed,) = overview(self.session)["feeds"]
+        self.assertNotIn(self.items[0].id, [item.id for item in feed["items"]])
+        # overlaid, not written
+        self.assertEqual(self._visited_ids(), set())
+
+    def test_visits_to_missing_items_are_dropped(self):
+        record_visit(self.session, 12345)
+        flush_visits(self.session)
+        self.assertEqual(self._visited_ids(), set())
+        self.assertEqual(logic.visit_log(self.session).read(), {})
+
+
+class SharedVisitLogTests(unittest.TestCase):
+    """Visits logged next to a database file, as the server's processes share them."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmpdir.name, "visits.db")
+        # fail fast instead of waiting for locks
+        self.engine = create_engine(
+            f"sqlite:///{self.db_path}", connect_args={"timeout": 0.1}
+        )
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.item = Item(
+            title="Item",
+            link="http://example.com/item",
+            published=datetime.now(),
+            feed=Feed(url="http://example.com"),
+        )
+        self.session.add(self.item)
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def test_reads_do_not_fail_while_the_database_is_locked(self):
+        record_visit(self.session, self.item.id)
+        self.session.rollback()
+        # e.g. the updater or a restore holding the write lock
+        writer = sqlite3.connect(self.db_path, isolation_level=None)
+        writer.execute("BEGIN IMMEDIATE")
+        try:
+            (visited,) = item_list(self.session, "visited", 0, None)["items"]
+            self.assertEqual(visited.id, self.item.id)
+            self.assertEqual(overview(self.session)["feeds"], [])
+            self.assertEqual(unvisited_items_after(self.session, datetime.min), [])
+            self.session.rollback()
+            with self.assertRaises(OperationalError):
+                flush_visits(self.session)
+            self.assertIn(self.item.id, logic.visit_log(self.session).read())
+        finally:
+            writer.rollback()
+            writer.close()
+
+        flush_visits(self.session)
+        self.session.expire_all()
+        self.assertIsNotNone(self.session.get(Item, self.item.id).visited)
+        self.assertEqual(logic.visit_log(self.session).read(), {})
+
+    def test_visits_are_shared_between_processes(self):
+        repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys, sqlalchemy, logic; logic.record_visit("
+                "sqlalchemy.create_engine(f'sqlite:///{sys.argv[1]}'), int(sys.argv[2]))",
+                self.db_path,
+                str(self.item.id),
+            ],
+            env={**os.environ, "PYTHONPATH": repo},
+            check=True,
+        )
+        (visited,) = item_list(self.session, "visited", 0, None)["items"]
+        self.assertEqual(visited.id, self.item.id)
+        flush_visits(self.session)
+        self.session.expire_all()
+        self.assertIsNotNone(self.session.get(Item, self.item.id).visited)
+
+    def test_only_one_flusher_at_a_time(self):
+        # another process's handle on the same log
+        other = VisitLog(logic.visit_log(self.session).path)
+        other.append(self.item.id, datetime.now())
+        with other.flushing() as visits:
+            self.assertEqual(list(visits), [self.item.id])
+            flush_visits(self.session)
+            self.session.expire_all()
+            self.assertIsNone(self.session.get(Item, self.item.id).visited)
+            # appended during the flush, so kept for the next one
+            other.append(self.item.id + 1, datetime.now())
+        self.assertEqual(list(other.read()), [self.item.id + 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,299 @@
+import hashlib
+import hmac
+import unittest
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs
+
+from sqlalchemy.orm import sessionmaker
+
+from local_server import LocalServer, hours_ago, rss
+from models import Feed, FeedLease, Item, WebSubPush, WebSubSubscription
+
+# bound to the database chosen in conftest.py
+import server
+import websub
+from update import claim_feeds, update_feed, update_feeds
+
+CALLBACK_BASE = "http://rsrssr.test"
+
+
+def rss_with_links(*entries, hub=None, self_url=None):
+    links = ""
+    if hub:
+        links += f'<atom:link rel="hub" href="{hub}"/>'
+    if self_url:
+        links += f'<atom:link rel="self" href="{self_url}"/>'
+    return (
+        '<?xml version="1.0"?><rss version="2.0" '
+        'xmlns:atom="http://www.w3.org/2005/Atom"><channel><title>Pushed</title>'
+        + links
+        + "".join(
+            f"<item><title>{t}</title><link>{l}</link><pubDate>{d}</pubDate></item>"
+            for t, l, d in entries
+        )
+        + "</channel></rss>"
+    ).encode("utf-8")
+
+
+class TestDiscovery(unittest.TestCase):
+    def test_link_header_is_preferred(self):
+        body = rss_with_links(hub="https://doc-hub.example", self_url="https://a/doc")
+        headers = {
+            "link": '<https://hub.example/>; rel="hub", <https://a/feed>; rel=self'
+        }
+        self.assertEqual(
+            websub.discover_hub(body, headers),
+            ("https://hub.example/", "https://a/feed"),
+        )
+
+    def test_rss_and_atom_documents(self):
+        body = rss_with_links(
+            ("Post", "https://a/post", hours_ago(1)),
+            hub="https://hub.example/",
+            self_url="https://a/feed",
+        )
+        self.assertEqual(
+            websub.discover_hub(body, {}), ("https://hub.example/", "https://a/feed")
+        )
+        atom = (
+            b'<?xml version="1.0"?><feed xmlns="http://www.w3.org/2005/Atom">'
+            b'<link rel="alternate" href="https://a/"/>'
+            b'<link rel="hub" href="https://hub.example/"/>'
+            b'<entry><link rel="self" href="https://a/entry"/></entry></feed>'
+        )
+        self.assertEqual(websub.discover_hub(atom, {}), ("https://hub.example/", None))
+
+    def test_no_hub(self):
+        self.assertEqual(websub.discover_hub(rss(), {}), (None, None))
+        self.assertEqual(websub.discover_hub(b"<rss><channel", {}), (None, None))
+
+    def test_signature(self):
+        body = b"<rss/>"
+        signature = hmac.new(b"secret", body, hashlib.sha256).hexdigest()
+        self.assertTrue(websub.signature_matches("secret", body, f"sha256={signature}"))
+        self.assertFalse(websub.signature_matches("other", body, f"sha256={signature}"))
+        self.assertFalse(websub.signature_matches("secret", body, f"md5={signature}"))
+        self.assertFalse(websub.signature_matches("secret", body, None))
+
+
+class TestWebSubFlow(unittest.TestCase):
+    """Subscribing through a local hub stand-in, which calls back into the server."""
+
+    def setUp(self):
+        with server.app.app_context():
+            engine = server.db.engine
+        self.session = sessionmaker(bind=engine)()
+        self.client = server.app.test_client()
+        self.feed_body = rss_with_links(
+            ("Post", "https://example.com/post", hours_ago(2)),
+            hub="/hub",
+            self_url="https://example.com/feed",
+        )
+        self.server = LocalServer(
+            {
+                "/feed": lambda handler: (200, {}, self.feed_body),
+                "/hub": (202, {}, b""),
+            }
+        )
+        self.server.__enter__()
+        self.feed_body = self.feed_body.replace(
+            b'href="/hub"', f'href="{self.server.url("/hub")}"'.encode()
+        )
+        self.feed = Feed(url=self.server.url("/feed"))
+        self.session.add(self.feed)
+        self.session.commit()
+        self.callback = f"/websub/{self.feed.id}"
+
+    def tearDown(self):
+        self.server.__exit__()
+        self.session.delete(self.feed)
+        self.session.commit()
+        self.session.close()
+
+    def subscribe(self):
+        update_feed(self.session, self.feed)
+        self.session.commit()
+        num_requested, num_failed = websub.renew_subscriptions(
+            self.session, CALLBACK_BASE
+        )
+        self.assertEqual((num_requested, num_failed), (1, 0))
+        _, _, _, body = self.server.requests[-1]
+        return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+    def verify(self, request, **params):
+        args = {
+            "hub.mode": "subscribe",
+            "hub.topic": request["hub.topic"],
+            "hub.challenge": "challenge-123",
+            "hub.lease_seconds": "3600",
+        }
+        args.update(params)
+        return self.client.get(self.callback, query_string=args)
+
+    def push(self, body, secret):
+        signature = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+        return self.client.post(
+            self.callback,
+            data=body,
+            headers={
+                "Content-Type": "application/rss+xml",
+                "X-Hub-Signature": f"sha256={signature}",
+            },
+        )
+
+    def test_subscribe_verify_and_receive_pushes(self):
+        request = self.subscribe()
+        self.assertEqual(request["hub.mode"], "subscribe")
+        self.assertEqual(request["hub.topic"], "https://example.com/feed")
+        self.assertEqual(
+            request["hub.callback"], f"{CALLBACK_BASE}/websub/{self.feed.id}"
+        )
+        subscription = self.session.get(WebSubSubscription, self.feed.id)
+        self.assertEqual(request["hub.secret"], subscription.secret)
+        self.assertIsNone(subscription.expires)
+
+        self.assertEqual(
+            self.verify(request, **{"hub.topic": "other"}).status_code, 404
+        )
+        response = self.verify(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(as_text=True), "challenge-123")
+        self.session.expire_all()
+        subscription = self.session.get(WebSubSubscription, self.feed.id)
+        self.assertAlmostEqual(
+            subscription.expires,
+            datetime.now() + timedelta(hours=1),
+            delta=timedelta(minutes=1),
+        )
+
+        pushed = rss(("Pushed", "https://example.com/pushed", hours_ago(1)))
+        self.assertEqual(self.push(pushed, "wrong secret").status_code, 204)
+        self.assertEqual(
+            self.session.query(Item).filter_by(feed_id=self.feed.id).count(), 1
+        )
+        self.assertEqual(self.push(pushed, subscription.secret).status_code, 204)
+        titles = {
+            title
+            for (title,) in self.session.query(Item.title).filter_by(
+                feed_id=self.feed.id
+            )
+        }
+        self.assertEqual(titles, {"Post", "Pushed"})
+
+    def test_push_while_an_updater_holds_the_lease(self):
+        self.verify(self.subscribe())
+        self.session.expire_all()
+        subscription = self.session.get(WebSubSubscription, self.feed.id)
+        pushed = rss(("Pushed", "https://example.com/pushed", hours_ago(1)))
+        queued = []
+
+        def update_while_pushed(worker_session, feed):
+            if feed.id != self.feed.id:
+                # other tests' feeds, in the shared database
+                return None
+            # the hub pushes while this updater is fetching the feed
+            self.assertEqual(self.push(pushed, subscription.secret).status_code, 204)
+            queued.append(
+                (
+                    worker_session.query(Item)
+                    .filter_by(feed_id=feed.id, title="Pushed")
+                    .count(),
+                    worker_session.query(WebSubPush).filter_by(feed_id=feed.id).count(),
+                )
+            )
+            return update_feed(worker_session, feed)
+
+        update_feeds(
+            self.session,
+            update_fn=update_while_pushed,
+            max_workers=1,
+            instance="updater",
+        )
+        # queued rather than ingested alongside the updater, which then added it
+        self.assertEqual(queued, [(0, 1)])
+        self.session.expire_all()
+        self.assertEqual(
+            self.session.query(Item)
+            .filter_by(feed_id=self.feed.id, title="Pushed")
+            .count(),
+            1,
+        )
+        self.assertEqual(
+            self.session.query(WebSubPush).filter_by(feed_id=self.feed.id).count(), 0
+        )
+        self.assertIsNone(self.session.get(FeedLease, self.feed.id).owner)
+
+    def test_push_enabled_feeds_fall_back_to_long_polling(self):
+        self.verify(self.subscribe())
+        self.session.expire_all()
+        feed_id = self.feed.id
+        now = datetime.now()
+        self.feed.last_fetched = now - timedelta(hours=2)
+        self.session.commit()
+
+        def claimable(now):
+            claimed = claim_feeds(self.session, "test", 1000, now=now)
+            self.session.query(FeedLease).filter_by(owner="test").update(
+                {FeedLease.owner: None, FeedLease.expires: None}
+            )
+            self.session.commit()
+            return feed_id in claimed
+
+        self.assertFalse(claimable(now))
+        # polled like any other feed once the subscription expires
+        self.assertTrue(claimable(now + timedelta(hours=2)))
+
+    def test_renewal(self):
+        request = self.subscribe()
+        now = datetime.now()
+        # unverified requests are only sent again after a while
+        self.assertEqual(
+            websub.renew_subscriptions(self.session, CALLBACK_BASE), (0, 0)
+        )
+        self.verify(request, **{"hub.lease_seconds": str(10 * 24 * 3600)})
+        self.session.expire_all()
+        self.assertEqual(
+            websub.renew_subscriptions(
+                self.session, CALLBACK_BASE, now=now + timedelta(days=5)
+            ),
+            (0, 0),
+        )
+        self.assertEqual(
+            websub.renew_subscriptions(
+                self.session, CALLBACK_BASE, now=now + timedelta(days=9, hours=12)
+            ),
+            (1, 0),
+        )
+
+    def test_denied_subscription_is_not_retried(self):
+        request = self.subscribe()
+        response = self.verify(request, **{"hub.mode": "denied"})
+        self.assertEqual(response.status_code, 200)
+        later = datetime.now() + timedelta(hours=2)
+        self.session.expire_all()
+        self.assertEqual(
+            websub.renew_subscriptions(self.session, CALLBACK_BASE, now=later), (0, 0)
+        )
+
+    def test_unrequested_verification_and_unknown_feeds_are_refused(self):
+        update_feed(self.session, self.feed)
+        self.session.commit()
+        request = {"hub.topic": "https://example.com/feed"}
+        self.assertEqual(self.verify(request).status_code, 404)
+        self.assertEqual(
+            self.client.get(
+                "/websub/999999", query_string={"hub.mode": "subscribe"}
+            ).status_code,
+            404,
+        )
+
+    def test_subscription_dropped_when_hub_is_no_longer_advertised(self):
+        self.subscribe()
+        self.feed_body = rss(("Newer", "https://example.com/newer", hours_ago(1)))
+        update_feed(self.session, self.feed)
+        self.session.commit()
+        self.assertIsNone(self.session.get(WebSubSubscription, self.feed.id))
+
+
+if __name__ == "__main__":
+    unittest.main()
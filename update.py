@@ -1,29 +1,141 @@
+import os
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import gzip
+import socket
+import zlib
+import hashlib
+import urllib.error
+import urllib.request
+import multiprocessing
+from contextlib import ExitStack
+from functools import partial
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
 
 import feedparser
 from statistics import mean, stdev
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 from dateutil.relativedelta import relativedelta
-from sqlalchemy import create_engine, text
+from sqlalchemy import (
+    and_,
+    create_engine,
+    exists,
+    insert,
+    or_,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import sessionmaker
-from models import Base, Item, Feed, UpdateStat
+from models import (
+    Item,
+    ItemFingerprint,
+    Feed,
+    FeedLease,
+    ProxiedImage,
+    UpdateStat,
+    WebSubPush,
+    WebSubSubscription,
+    migrate,
+)
+from parsing import parse_feed
+import image_proxy
+from backup import DATABASE_PATH, backup_due, create_snapshot
+import websub
 
-engine = create_engine("sqlite:///instance/rss_feeds.db")
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
-Base.metadata.create_all(engine)
+# query parameters that only track where a click came from and never change the article:
+# any parameter starting with one of the prefixes, and the exact names
+TRACKING_QUERY_PREFIXES = ("utm_",)
+TRACKING_QUERY_PARAMS = {"fbclid", "gclid", "mc_cid", "mc_eid", "ref"}
 
-# Migrate: add dismissed column if it doesn't exist
-with engine.connect() as conn:
-    existing = conn.execute(text("PRAGMA table_info('item')")).mappings().all()
-    if not any(row["name"] == "dismissed" for row in existing):
-        conn.execute(text("ALTER TABLE item ADD COLUMN dismissed DATETIME"))
 
-Session = sessionmaker(bind=engine)
+def is_tracking_param(key):
+    key = key.lower()
+    return key.startswith(TRACKING_QUERY_PREFIXES) or key in TRACKING_QUERY_PARAMS
 
 
-def datetime_from_time(t):
-    return datetime.fromtimestamp(time.mktime(t))
+def normalize_link(link):
+    """Reduce a link to a canonical form so that mirrors of an article compare equal."""
+    parts = urlsplit(link.strip())
+    host = (parts.hostname or "").lower().removeprefix("www.")
+    if parts.port and parts.port not in (80, 443):
+        host = f"{host}:{parts.port}"
+    query = urlencode(
+        sorted(
+            (key, value)
+            for key, value in parse_qsl(parts.query, keep_blank_values=True)
+            if not is_tracking_param(key)
+        )
+    )
+    return urlunsplit(("", host, parts.path.rstrip("/"), query, ""))
+
+
+def item_fingerprint(link, title, description):
+    """Fingerprint an item by its normalized link, or by its content if it has no link."""
+    if link and urlsplit(link).scheme in ("http", "https"):
+        key = "link:" + normalize_link(link)
+    else:
+        key = f"content:{(title or '').strip()}\n{(description or '').strip()}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def link_duplicate_items(session, items):
+    """
+    Record the fingerprint of each new item, pointing items that were already seen
+    (in this batch or any other feed) at the first copy via `canonical_id`.
+
+    The items must have been flushed so that they have ids.
+    """
+    fingerprints = {
+        item: item_fingerprint(item.link, item.title, item.description)
+        for item in items
+    }
+    # the flush holds SQLite's write lock, so no other updater can insert between this and the insert below
+    canonical = dict(
+        session.execute(
+            select(ItemFingerprint.fingerprint, Item)
+            .join(Item, Item.id == ItemFingerprint.item_id)
+            .where(ItemFingerprint.fingerprint.in_(set(fingerprints.values())))
+        ).all()
+    )
+    new_fingerprints = []
+    for item, fingerprint in fingerprints.items():
+        first = canonical.get(fingerprint)
+        if first is None:
+            canonical[fingerprint] = item
+            new_fingerprints.append({"fingerprint": fingerprint, "item_id": item.id})
+        elif first is not item:
+            item.canonical_id = first.id
+            # a copy of an item that was already read, dismissed or liked is too
+            item.visited = first.visited
+            item.dismissed = first.dismissed
+            item.liked = first.liked
+    if new_fingerprints:
+        session.execute(insert(ItemFingerprint), new_fingerprints)
+
+
+def proxy_item_images(session, items):
+    """Rewrite the images in the items' descriptions to be served by the local image proxy."""
+    images = {}
+    for item in items:
+        item.description, item_images = image_proxy.rewrite_image_urls(item.description)
+        images.update(item_images)
+    if images:
+        session.execute(
+            sqlite_insert(ProxiedImage).on_conflict_do_nothing(),
+            [{"key": key, "url": url} for key, url in images.items()],
+        )
 
 
 def get_last_published_date(session, feed):
@@ -40,80 +152,332 @@ def get_last_published_date(session, feed):
         return datetime.now() - relativedelta(months=2)
 
 
-def update_feed(session, feed):
+# seconds to wait for a feed server before giving up
+FETCH_TIMEOUT = 30
+
+# content encodings we accept from feed servers; Brotli needs the optional `brotli` package
+FETCH_ACCEPT_ENCODING = "gzip, br" if brotli is not None else "gzip"
+
+
+def decode_body(body, content_encoding):
+    match (content_encoding or "").strip().lower():
+        case "gzip" | "x-gzip":
+            return gzip.decompress(body)
+        case "deflate":
+            return zlib.decompress(body)
+        case "br" if brotli is not None:
+            return brotli.decompress(body)
+        case "" | "identity":
+            return body
+        case other:
+            raise ValueError(f"unsupported content encoding {other!r}")
+
+
+def fetch_feed(feed):
+    """
+    Download a feed, sending the cache validators saved from the last fetch and
+    asking for an RFC 3229 delta of just the entries added since then.
+    Returns the (lowercased) response headers, the decoded body, the number of
+    bytes received and whether the body is a delta, or None if the server says
+    the feed has not been modified.
+    """
+    request = urllib.request.Request(
+        feed.url,
+        headers={
+            "User-Agent": feedparser.USER_AGENT,
+            "Accept-Encoding": FETCH_ACCEPT_ENCODING,
+            "A-IM": "feed",
+        },
+    )
+    if feed.etag:
+        request.add_header("If-None-Match", feed.etag)
+    if feed.modified:
+        request.add_header("If-Modified-Since", feed.modified)
+    try:
+        with urllib.request.urlopen(request, timeout=FETCH_TIMEOUT) as response:
+            status = response.status
+            headers = {key.lower(): value for key, value in response.headers.items()}
+            headers["content-location"] = response.url
+            body = response.read()
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None
+        raise
+    delta = status == 226
+    if delta:
+        manipulations = [im.strip() for im in headers.get("im", "").split(",")]
+        if "feed" not in manipulations:
+            raise ValueError(f"unsupported instance manipulation {headers.get('im')!r}")
+    return headers, decode_body(body, headers.get("content-encoding")), len(body), delta
+
+
+def record_bytes(feed, received, decoded, full_size):
+    """
+    Count a download towards the feed's totals. Returns how many fewer bytes
+    were received than the full, uncompressed document has.
+    """
+    feed.bytes_received = (feed.bytes_received or 0) + received
+    feed.bytes_decoded = (feed.bytes_decoded or 0) + decoded
+    return max(0, full_size - received)
+
+
+def ingest_feed(session, feed, body, headers, *, parse_pool=None):
+    """
+    Add the new entries of a feed document to the feed, whether it was polled
+    or pushed by a WebSub hub. Returns the new items.
+    """
+    last_published_date = get_last_published_date(session, feed)
+    if parse_pool is None:
+        feed_title, entries = parse_feed(body, headers, last_published_date)
+    else:
+        feed_title, entries = parse_pool.submit(
+            parse_feed, body, headers, last_published_date
+        ).result()
+    session.add(feed)
+    if not feed.title:
+        feed.title = feed_title or feed.url
+    feed.last_updated = datetime.now()
+    items = [
+        Item(
+            title=title,
+            link=link,
+            published=published,
+            description=description,
+            author=author,
+            feed=feed,
+        )
+        for title, link, published, description, author in entries
+    ]
+    # added first, since recording the proxied images flushes the session
+    session.add_all(items)
+    if image_proxy.PROXY_IMAGES:
+        proxy_item_images(session, items)
+    if items:
+        session.flush()
+        link_duplicate_items(session, items)
+    return items
+
+
+def update_feed(session, feed, *, parse_pool=None):
     print(f"updating feed {feed.url} (#{feed.id})")
     start_time = time.time()
-    data = feedparser.parse(feed.url, etag=feed.etag, modified=feed.modified)
-    if data.status == 304:
+    response = fetch_feed(feed)
+    if response is None:
+        return {
+            "id": feed.id,
+            "num_new_items": 0,
+            "dur": (time.time() - start_time) * 1000,
+            "cache_miss": False,
+            "bytes_received": 0,
+            "bytes_decoded": 0,
+            "bytes_saved": record_bytes(feed, 0, 0, feed.document_size or 0),
+        }
+    headers, body, num_bytes, delta = response
+    if delta:
+        # a delta holds only the new entries, and saved downloading the rest
+        bytes_saved = record_bytes(
+            feed, num_bytes, len(body), feed.document_size or len(body)
+        )
+    else:
+        bytes_saved = record_bytes(feed, num_bytes, len(body), len(body))
+        feed.document_size = len(body)
+    # servers that don't support conditional requests (or ignore them) often
+    # send exactly the same document again, which can be detected without parsing it
+    content_hash = hashlib.sha256(body).hexdigest()
+    if not delta and content_hash == feed.content_hash:
         end_time = time.time()
         return {
             "id": feed.id,
             "num_new_items": 0,
             "dur": (end_time - start_time) * 1000,
             "cache_miss": False,
+            "bytes_received": num_bytes,
+            "bytes_decoded": len(body),
+            "bytes_saved": bytes_saved,
         }
-    session.add(feed)
-    if not feed.title:
-        feed.title = data.feed.get("title", feed.title or feed.url)
-    feed.etag = data.get("etag", None)
-    feed.modified = data.get("modified", None)
-    feed.last_updated = datetime.now()
-    feed_pub_date = data.feed.get(
-        "published_parsed", data.feed.get("updated_parsed", time.localtime())
-    )
-    last_published_date = get_last_published_date(session, feed)
-    items = list(
-        filter(
-            lambda item: item.published > last_published_date,
-            (
-                Item(
-                    title=entry.get("title", entry.get("link", "Untitled Item")),
-                    link=entry.get(
-                        "link", 'javascript:alert("no link provided for item")'
-                    ),
-                    published=datetime_from_time(
-                        entry.get(
-                            "published_parsed",
-                            entry.get("updated_parsed", feed_pub_date),
-                        )
-                    ),
-                    description=entry.get("description", None),
-                    author=entry.get("author", None),
-                    feed=feed,
-                )
-                for entry in data.entries
-            ),
-        )
-    )
-    session.add_all(items)
+    feed.etag = headers.get("etag", None)
+    feed.modified = headers.get("last-modified", None)
+    # the hash of a delta says nothing about the next full document
+    feed.content_hash = None if delta else content_hash
+    if not delta:
+        websub.record_hub(session, feed, *websub.discover_hub(body, headers))
+    items = ingest_feed(session, feed, body, headers, parse_pool=parse_pool)
     end_time = time.time()
     return {
         "id": feed.id,
         "num_new_items": len(items),
         "dur": (end_time - start_time) * 1000,
         "cache_miss": True,
+        "bytes_received": num_bytes,
+        "bytes_decoded": len(body),
+        "bytes_saved": bytes_saved,
     }
 
 
-def should_skip_feed(feed, now):
-    return (
-        feed.etag is None
-        and feed.modified is None
-        and feed.last_updated is not None
-        and abs(feed.last_updated - now) < timedelta(hours=6)
+# number of processes used to parse feeds; None uses one per CPU, 0 parses in the fetching threads
+PARSE_WORKERS = None
+
+# number of feeds fetched at once by each updater instance
+MAX_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+# how often systemd/rsrssr-update.timer starts the updater. Its random delay is
+# the same every hour (FixedRandomDelay=true), so runs are this far apart.
+UPDATE_TIMER_INTERVAL = timedelta(hours=1)
+
+# a feed is due to be fetched again once this long has passed since it was last
+# fetched: a little less than the time between runs, since a feed's fetch time
+# is when it finished, and feeds fetched late in one run must be due in the next
+FETCH_INTERVAL = UPDATE_TIMER_INTERVAL - timedelta(minutes=15)
+
+# feeds whose WebSub hub pushes their updates are still polled this often, in case a push is lost
+WEBSUB_FETCH_INTERVAL = timedelta(days=1)
+
+# how long an updater instance may hold a feed before another instance can claim it,
+# and how often the leases of feeds that are still being fetched are extended
+LEASE_DURATION = timedelta(minutes=5)
+LEASE_RENEW_INTERVAL = timedelta(minutes=1)
+
+
+def default_instance_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def claim_feeds(session, owner, limit, now=None):
+    """
+    Lease up to `limit` due feeds that no other updater instance holds,
+    least recently fetched first. Returns the ids of the claimed feeds.
+    """
+    now = now or datetime.now()
+    session.execute(
+        insert(FeedLease).from_select(
+            ["feed_id"],
+            select(Feed.id).where(~exists().where(FeedLease.feed_id == Feed.id)),
+        )
+    )
+    due = (
+        select(FeedLease.feed_id)
+        .join(Feed, Feed.id == FeedLease.feed_id)
+        .outerjoin(WebSubSubscription, WebSubSubscription.feed_id == Feed.id)
+        .where(
+            or_(FeedLease.expires == None, FeedLease.expires < now),
+            or_(
+                Feed.last_fetched == None,
+                Feed.last_fetched < now - WEBSUB_FETCH_INTERVAL,
+                # content was pushed while another instance held the feed, and
+                # has not been tried since (so a failing push is not retried at once)
+                exists().where(
+                    WebSubPush.feed_id == Feed.id,
+                    or_(
+                        Feed.last_fetched == None,
+                        WebSubPush.received > Feed.last_fetched,
+                    ),
+                ),
+                and_(
+                    Feed.last_fetched < now - FETCH_INTERVAL,
+                    ~websub.push_active(now),
+                ),
+            ),
+        )
+        .order_by(Feed.last_fetched)
+        .limit(limit)
+    )
+    # a single UPDATE, so two instances can never claim the same feed
+    claimed = (
+        session.execute(
+            update(FeedLease)
+            .where(FeedLease.feed_id.in_(due.scalar_subquery()))
+            .values(owner=owner, expires=now + LEASE_DURATION)
+            .returning(FeedLease.feed_id)
+        )
+        .scalars()
+        .all()
+    )
+    session.commit()
+    return claimed
+
+
+def claim_feed(session, feed_id, owner, now=None) -> bool:
+    """
+    Lease one feed whether or not it is due, e.g. to add content pushed for
+    it, unless another instance holds it. Returns whether it was claimed.
+    """
+    now = now or datetime.now()
+    session.execute(
+        sqlite_insert(FeedLease).values(feed_id=feed_id).on_conflict_do_nothing()
+    )
+    claimed = session.execute(
+        update(FeedLease)
+        .where(
+            FeedLease.feed_id == feed_id,
+            or_(FeedLease.expires == None, FeedLease.expires < now),
+        )
+        .values(owner=owner, expires=now + LEASE_DURATION)
+        .returning(FeedLease.feed_id)
+    ).first()
+    session.commit()
+    return claimed is not None
+
+
+def renew_leases(session, owner, feed_ids):
+    """Extend the leases this instance still holds on `feed_ids`."""
+    session.execute(
+        update(FeedLease)
+        .where(FeedLease.feed_id.in_(feed_ids), FeedLease.owner == owner)
+        .values(expires=datetime.now() + LEASE_DURATION)
     )
+    session.commit()
+
+
+def release_lease(session, feed_id, owner, *, fetched=True):
+    """Give up the lease on a feed, marking it as fetched if it was."""
+    session.execute(
+        update(FeedLease)
+        .where(FeedLease.feed_id == feed_id, FeedLease.owner == owner)
+        .values(owner=None, expires=None)
+    )
+    if fetched:
+        session.execute(
+            update(Feed).where(Feed.id == feed_id).values(last_fetched=datetime.now())
+        )
 
 
-def update_feeds(session, *, update_fn=update_feed, max_workers=None):
+def ingest_pushes(session, feed):
+    """
+    Add the content that was pushed for a feed while it was leased, oldest
+    first. The caller must hold the feed's lease. Returns the new items.
+    """
+    items = []
+    for push in feed.pushes:
+        headers = {
+            "content-type": push.content_type or "",
+            "content-location": feed.websub.topic if feed.websub else feed.url,
+        }
+        items += ingest_feed(session, feed, push.body, headers)
+        session.delete(push)
+    return items
+
+
+def update_feeds(
+    session,
+    *,
+    update_fn=None,
+    max_workers=MAX_WORKERS,
+    parse_workers=PARSE_WORKERS,
+    instance=None,
+):
+    """
+    Fetch every due feed that is not leased by another updater instance.
+    Several instances can run at once against the same database, each
+    claiming batches of feeds until none are left.
+    """
     timestamp = datetime.now()
     start_time = time.time()
+    instance = instance or default_instance_name()
+    max_workers = max_workers or MAX_WORKERS
     num_failed = 0
-    feeds = session.query(Feed).all()
+    num_feeds = session.query(Feed).count()
     feed_update_stats = []
-    print(f"updating {len(feeds)} feeds")
-    now = datetime.now()
-    feeds_to_update = [feed for feed in feeds if not should_skip_feed(feed, now)]
-    feed_lookup = {feed.id: feed for feed in feeds}
+    print(f"updating {num_feeds} feeds as {instance}")
     session_bind = session.get_bind()
     if session_bind is None:
         raise RuntimeError("Session is not bound to an engine")
@@ -125,39 +489,84 @@ def update_feeds(session, *, update_fn=update_feed, max_workers=None):
             feed = worker_session.get(Feed, feed_id)
             if feed is None:
                 return None
-            stats = update_fn(worker_session, feed)
-            worker_session.commit()
+            try:
+                stats = update_fn(worker_session, feed)
+                worker_session.commit()
+            except Exception:
+                worker_session.rollback()
+                raise
+            finally:
+                # content pushed while the feed was leased is added even if the fetch failed
+                ingest_pushes(worker_session, feed)
+                worker_session.commit()
             return stats
         except Exception:
             worker_session.rollback()
             raise
         finally:
+            release_lease(worker_session, feed_id, instance)
+            worker_session.commit()
             worker_session.close()
 
-    if feeds_to_update:
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_map = {
-                executor.submit(process_feed, feed.id): feed.id for feed in feeds_to_update
-            }
-            for future in as_completed(future_map):
-                feed_id = future_map[future]
+    with ExitStack() as stack:
+        if update_fn is None:
+            parse_pool = None
+            if parse_workers != 0:
+                # spawn rather than fork, since the fetching threads are already running
+                parse_pool = stack.enter_context(
+                    ProcessPoolExecutor(
+                        max_workers=parse_workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+                )
+            update_fn = partial(update_feed, parse_pool=parse_pool)
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=max_workers))
+        in_flight = {}
+        out_of_feeds = False
+        last_renewal = time.monotonic()
+        while True:
+            # keep a batch queued behind the running fetches, claiming more once half have finished
+            if not out_of_feeds and len(in_flight) < max_workers:
+                claimed = claim_feeds(
+                    session, instance, 2 * max_workers - len(in_flight)
+                )
+                out_of_feeds = not claimed
+                for feed_id in claimed:
+                    in_flight[executor.submit(process_feed, feed_id)] = feed_id
+            if not in_flight:
+                break
+            done, _ = wait(
+                in_flight,
+                timeout=LEASE_RENEW_INTERVAL.total_seconds(),
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                feed_id = in_flight.pop(future)
                 try:
                     stats = future.result()
                 except Exception as e:
-                    feed = feed_lookup.get(feed_id)
+                    feed = session.get(Feed, feed_id)
                     url = feed.url if feed else "<unknown>"
                     print(f"failed to load feed #{feed_id} ({url}): {e}")
                     num_failed += 1
                 else:
                     if stats is not None:
                         feed_update_stats.append(stats)
+            if (
+                in_flight
+                and time.monotonic() - last_renewal
+                >= LEASE_RENEW_INTERVAL.total_seconds()
+            ):
+                renew_leases(session, instance, list(in_flight.values()))
+                last_renewal = time.monotonic()
     session.commit()
     end_time = time.time()
     min_feed_stat = min(feed_update_stats, key=lambda s: s["dur"], default=None)
     max_feed_stat = max(feed_update_stats, key=lambda s: s["dur"], default=None)
     return UpdateStat(
         timestamp=timestamp,
-        num_feeds=len(feeds),
+        instance=instance,
+        num_feeds=num_feeds,
         num_fetched=len(feed_update_stats),
         num_updated=sum(1 for s in feed_update_stats if s["cache_miss"]),
         num_failed=num_failed,
@@ -177,13 +586,36 @@ def update_feeds(session, *, update_fn=update_feed, max_workers=None):
         ),
         dur_max_feed=max_feed_stat["dur"] if max_feed_stat else 0,
         dur_max_feed_id=max_feed_stat["id"] if max_feed_stat else None,
+        bytes_received=sum(s.get("bytes_received", 0) for s in feed_update_stats),
+        bytes_decoded=sum(s.get("bytes_decoded", 0) for s in feed_update_stats),
+        bytes_saved=sum(s.get("bytes_saved", 0) for s in feed_update_stats),
     )
 
 
-if __name__ == "__main__":
-    session = Session()
+def main():
+    # set up here rather than at import, since worker processes re-import this module
+    engine = create_engine(f"sqlite:///{DATABASE_PATH}")
+    migrate(engine)
+    session = sessionmaker(bind=engine)()
     stats = update_feeds(session)
-    print(f"update took {stats.dur_total}s")
+    print(
+        f"update took {stats.dur_total}s, received {stats.bytes_received} bytes "
+        f"and saved {stats.bytes_saved}"
+    )
     session.add(stats)
     session.commit()
+    num_requested, num_failed = websub.renew_subscriptions(session)
+    if num_requested:
+        print(f"sent {num_requested} WebSub subscription requests, {num_failed} failed")
+    # keep the query planner's statistics up to date as items accumulate
+    session.execute(text("PRAGMA optimize"))
+    if backup_due(session):
+        backup_stats = create_snapshot(DATABASE_PATH)
+        print(f"backed up to {backup_stats.path} in {backup_stats.dur:.2f}s")
+        session.add(backup_stats)
+        session.commit()
     print("finished!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+A durable log of visits that have been acknowledged but not yet written to the
+database, so that recording a visit never waits for SQLite's write lock.
+
+The log is a file next to the database, shared by every process serving it
+(each gunicorn worker, the ASGI app). Visits are appended one line at a time,
+reads overlay the logged visits on what the database holds, and whichever
+process flushes next writes the whole log in one transaction and then cuts
+what it wrote from the front of the file. Visits survive a worker being
+killed, and one that is written twice (if a flusher dies between committing and
+cutting the log) is simply written again with the same time.
+"""
+
+import contextlib
+import fcntl
+import os
+import threading
+from datetime import datetime
+
+# appended to the database's path to name its visit log, like SQLite's "-wal"
+VISIT_LOG_SUFFIX = "-visits"
+
+
+def log_path(database: str) -> str:
+    """The path of the visit log of an SQLite database file."""
+    return os.path.abspath(database) + VISIT_LOG_SUFFIX
+
+
+def parse_visits(data: bytes) -> dict[int, datetime]:
+    """The visits in complete log lines by item id, the latest for items visited again."""
+    visits = {}
+    for line in data[: data.rfind(b"\n") + 1].splitlines():
+        try:
+            item_id, when = line.split()
+            item_id, when = int(item_id), datetime.fromisoformat(when.decode())
+        except (ValueError, UnicodeDecodeError):
+            # left behind by a flusher that died while cutting the log
+            continue
+        visits[item_id] = max(when, visits.get(item_id, when))
+    return visits
+
+
+class VisitLog:
+    """
+    An append-only log of visits at `path`. Without a path (for in-memory
+    databases, which no other process can open) the log is kept in memory.
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = path
+        self.memory = b""
+        self.memory_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def append(self, item_id: int, when: datetime):
+        line = f"{item_id} {when.isoformat()}\n".encode("ascii")
+        if self.path is None:
+            with self.memory_lock:
+                self.memory += line
+            return
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            # shared with other appenders, so only a flush cutting the log waits for it
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def contents(self) -> bytes:
+        if self.path is None:
+            with self.memory_lock:
+                return self.memory
+        try:
+            with open(self.path, "rb") as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                return f.read()
+        except FileNotFoundError:
+            return b""
+
+    def read(self) -> dict[int, datetime]:
+        """The logged visits by item id."""
+        return parse_visits(self.contents())
+
+    @contextlib.contextmanager
+    def flushing(self):
+        """
+        Yield the logged visits to be written, and cut them from the log once
+        the block succeeds. Yields None if another thread or process is
+        already flushing; visits logged meanwhile are left for the next flush.
+        """
+        if not self.flush_lock.acquire(blocking=False):
+            yield None
+            return
+        try:
+            with self.exclusive() as flushing:
+                if not flushing:
+                    yield None
+                    return
+                data = self.contents()
+                data = data[: data.rfind(b"\n") + 1]
+                yield parse_visits(data)
+                if data:
+                    self.cut(len(data))
+        finally:
+            self.flush_lock.release()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        """Whether this process could become the only one flushing the log."""
+        if self.path is None:
+            yield True
+            return
+        with open(self.path + ".lock", "ab") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+
+    def cut(self, size: int):
+        """Remove the first `size` bytes of the log, keeping what was appended since."""
+        if self.path is None:
+            with self.memory_lock:
+                self.memory = self.memory[size:]
+            return
+        with open(self.path, "r+b") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(size)
+            rest = f.read()
+            f.seek(0)
+            f.write(rest)
+            f.truncate()
@@ -0,0 +1,222 @@
+"""
+WebSub (formerly PubSubHubbub) subscriptions, so that the hubs feeds advertise
+push new entries as soon as they are published instead of the updater finding
+them on its next poll.
+
+The updater records the hub of each feed it fetches, and subscribes to it (and
+renews the subscription before it expires) with `renew_subscriptions`. The hub
+verifies the subscription and then pushes content to the server's
+`/websub/<feed_id>` callback, which ingests it like a polled document, under the
+feed's lease; content pushed while an updater holds the lease is queued, and
+the updater adds it before giving the lease up. Feeds
+with a verified subscription are only polled every `WEBSUB_FETCH_INTERVAL`
+(in update.py), in case a push is lost.
+
+Hubs need to reach the server, so subscribing is off unless the server's public
+URL is set in the RSRSSR_WEBSUB_CALLBACK environment variable.
+"""
+
+import hmac
+import io
+import os
+import re
+import secrets
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_
+
+from models import WebSubSubscription
+
+# the server's public base URL, e.g. https://rss.example.com; None disables subscribing
+WEBSUB_CALLBACK_URL = os.environ.get("RSRSSR_WEBSUB_CALLBACK")
+
+# the lease asked of hubs, which may grant a different one
+WEBSUB_LEASE = timedelta(days=10)
+
+# subscriptions are renewed once they expire within this long
+WEBSUB_RENEW_BEFORE = timedelta(days=1)
+
+# a request the hub hasn't verified after this long is sent again
+WEBSUB_VERIFY_TIMEOUT = timedelta(hours=1)
+
+# how long to wait before asking a hub that refused a subscription again
+WEBSUB_DENIED_RETRY = timedelta(days=7)
+
+# seconds to wait for a hub before giving up
+HUB_TIMEOUT = 30
+
+# hash functions hubs may sign pushed content with, from the X-Hub-Signature header
+SIGNATURE_METHODS = ("sha1", "sha256", "sha384", "sha512")
+
+LINK_HEADER_RE = re.compile(r"<([^>]*)>([^<]*)")
+LINK_REL_RE = re.compile(r'rel\s*=\s*(?:"([^"]*)"|([^\s;,]+))')
+
+
+def parse_link_header(value: str) -> dict[str, str]:
+    """The first URL for each relation in an HTTP `Link` header."""
+    links = {}
+    for url, params in LINK_HEADER_RE.findall(value or ""):
+        match = LINK_REL_RE.search(params)
+        if match:
+            for rel in (match.group(1) or match.group(2)).split():
+                links.setdefault(rel.lower(), url.strip())
+    return links
+
+
+def document_links(body: bytes) -> dict[str, str]:
+    """
+    The first URL for each relation in the `<link>` elements of a feed document.
+    Only the document's head is read, since the links come before the entries.
+    """
+    links = {}
+    try:
+        for _, element in ET.iterparse(io.BytesIO(body), events=("start",)):
+            name = element.tag.rsplit("}", 1)[-1]
+            if name in ("item", "entry"):
+                break
+            rel, href = element.get("rel"), element.get("href")
+            if name == "link" and rel and href:
+                links.setdefault(rel.lower(), href.strip())
+    except ET.ParseError:
+        pass
+    return links
+
+
+def discover_hub(body: bytes, headers: dict[str, str]) -> tuple[str | None, str | None]:
+    """
+    Find the hub a feed advertises and the topic URL to subscribe to it with,
+    preferring the response's `Link` header to the document, as WebSub asks.
+    """
+    links = parse_link_header(headers.get("link"))
+    if "hub" not in links:
+        links = document_links(body)
+    return links.get("hub"), links.get("self")
+
+
+def record_hub(session, feed, hub: str | None, topic: str | None):
+    """
+    Keep the feed's subscription in step with the hub it advertises: start one
+    for a new hub, start over if the hub or topic changed, and drop it if the
+    feed no longer advertises a hub.
+    """
+    subscription = feed.websub
+    if hub is None:
+        if subscription is not None:
+            session.delete(subscription)
+            feed.websub = None
+        return
+    topic = topic or feed.url
+    if subscription is None:
+        feed.websub = WebSubSubscription(
+            hub=hub, topic=topic, secret=secrets.token_hex(32)
+        )
+    elif (subscription.hub, subscription.topic) != (hub, topic):
+        subscription.hub = hub
+        subscription.topic = topic
+        subscription.requested = subscription.expires = subscription.denied = None
+
+
+def callback_url(base: str, feed_id: int) -> str:
+    return f"{base.rstrip('/')}/websub/{feed_id}"
+
+
+def send_subscription_request(subscription, callback_base: str):
+    """Ask the hub to (re)subscribe; the hub then verifies it with the callback."""
+    data = urllib.parse.urlencode(
+        {
+            "hub.mode": "subscribe",
+            "hub.topic": subscription.topic,
+            "hub.callback": callback_url(callback_base, subscription.feed_id),
+            "hub.lease_seconds": int(WEBSUB_LEASE.total_seconds()),
+            "hub.secret": subscription.secret,
+        }
+    ).encode("ascii")
+    with urllib.request.urlopen(subscription.hub, data, timeout=HUB_TIMEOUT):
+        pass
+
+
+def renew_subscriptions(session, callback_base=None, now=None) -> tuple[int, int]:
+    """
+    Send subscription requests for new subscriptions and for those about to
+    expire. Returns the number of requests sent and how many of them failed.
+    """
+    callback_base = callback_base or WEBSUB_CALLBACK_URL
+    if not callback_base:
+        return 0, 0
+    now = now or datetime.now()
+    due = (
+        session.query(WebSubSubscription)
+        .filter(
+            or_(
+                WebSubSubscription.requested == None,
+                WebSubSubscription.requested < now - WEBSUB_VERIFY_TIMEOUT,
+            ),
+            or_(
+                WebSubSubscription.expires == None,
+                WebSubSubscription.expires < now + WEBSUB_RENEW_BEFORE,
+            ),
+            or_(
+                WebSubSubscription.denied == None,
+                WebSubSubscription.denied < now - WEBSUB_DENIED_RETRY,
+            ),
+        )
+        .all()
+    )
+    num_failed = 0
+    for subscription in due:
+        # committed first, since hubs may verify before they respond
+        subscription.requested = now
+        session.commit()
+        try:
+            send_subscription_request(subscription, callback_base)
+        except Exception as e:
+            print(
+                f"failed to subscribe to {subscription.topic} at {subscription.hub}: {e}"
+            )
+            num_failed += 1
+    return len(due), num_failed
+
+
+def push_active(now):
+    """A filter for subscriptions that hubs have verified and not yet expired."""
+    return and_(WebSubSubscription.expires != None, WebSubSubscription.expires > now)
+
+
+def verify_intent(subscription, args, now=None) -> str | None:
+    """
+    Answer a hub's verification request from the query arguments of a GET to
+    the callback. Returns the challenge to echo back, or None if the request
+    should be refused.
+    """
+    now = now or datetime.now()
+    mode = args.get("hub.mode")
+    if args.get("hub.topic") != subscription.topic:
+        return None
+    if mode == "denied":
+        subscription.expires = None
+        subscription.denied = now
+        return ""
+    challenge = args.get("hub.challenge")
+    # only subscriptions that were asked for are confirmed; unsubscribing is
+    # never asked for, since feeds are unsubscribed by refusing their pushes
+    if mode != "subscribe" or not challenge or subscription.requested is None:
+        return None
+    try:
+        lease = timedelta(seconds=int(args.get("hub.lease_seconds")))
+    except (TypeError, ValueError):
+        lease = WEBSUB_LEASE
+    subscription.expires = now + lease
+    subscription.denied = None
+    return challenge
+
+
+def signature_matches(secret: str, body: bytes, signature_header: str | None) -> bool:
+    """Check the `X-Hub-Signature` a hub signed pushed content with."""
+    method, _, signature = (signature_header or "").partition("=")
+    if method not in SIGNATURE_METHODS:
+        return False
+    expected = hmac.new(secret.encode("utf-8"), body, method).hexdigest()
+    return hmac.compare_digest(expected, signature.strip().lower())